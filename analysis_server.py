@@ -0,0 +1,191 @@
+import os
+import json
+import queue
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from qgis.PyQt.QtCore import Qt
+from qgis.core import (
+    QgsProject,
+    QgsApplication,
+    QgsVectorLayer,
+    QgsFeatureSource,
+    QgsProcessingFeedback,
+)
+
+####################################################################
+#### Warm analysis server.
+#### QGIS, Processing and the project are loaded once. The runs read the input files through their providers with the on-disk
+#### spatial indexes, and the windows of the inputs stay resident in the window cache of the algorithm between requests.
+#### Each request is a JSON object with SuitabilityAnalysis parameters, e.g.
+####     curl -N -X POST http://127.0.0.1:8765/run -d '{"INPUT_WATER_BUFFER": 150, "INPUT_MIN_WATER": 3000}'
+#### requests are queued to a worker pool, progress and the result are streamed back as one JSON object per line.
+#### the startup is guarded by __main__: the worker processes of the site selection re-import this file and must not start QGIS or the server
+
+#### paths
+path_app = "C:\Program Files\QGIS 3.16.9"
+path_project = './FinalQGIS/FinalProject.qgz'
+path_results = './FinalQGIS/data/results'
+
+#### server settings
+SERVER_ADDRESS = ('127.0.0.1', 8765)
+WORKERS = 2
+
+layers = [
+    #### SOUTH-EASTERN MELBOURNE
+    {
+        'fn_in': "./data/_FIXED_DATA/region.shp",
+        'input': 'INPUT_ADMIN',
+        'name': "ADMIN"
+    },
+    #### HYDROLOGY MAP
+    {
+        'fn_in': "./data/_FIXED_DATA/hydro.shp",
+        'input': 'INPUT_HYDRO',
+        'name': "HYDROLOGY"
+    },
+    #### PLANNING MAP
+    {
+        'fn_in': "./data/_FIXED_DATA/plan_zone.shp",
+        'input': 'INPUT_ZONES',
+        'name': "PLAN_ZONES"
+    },
+    #### VEGETATION MAP
+    {
+        'fn_in': "./data/_FIXED_DATA/vegetation.shp",
+        'input': 'INPUT_VEG',
+        'name': "VEGETATION"
+    }
+]
+
+class StreamingFeedback(QgsProcessingFeedback):
+    """ forwards the progress and the messages of a run to the queue of its request """
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+        #### progress is emitted from the worker thread, a direct connection puts it to the queue right away
+        self.progressChanged.connect(lambda progress: self.events.put({'progress': progress}), Qt.DirectConnection)
+
+    def pushInfo(self, info):
+        self.events.put({'info': info})
+        super().pushInfo(info)
+
+    def reportError(self, error, fatalError=False):
+        self.events.put({'warning': error})
+        super().reportError(error, fatalError)
+
+
+def run_analysis(request_id, request, feedback):
+    params = {}
+    for output in OUTPUT_INPUTS:
+        params[output] = f"{path_results}/{output.lower()}_{request_id}.gpkg"
+    params.update(request)
+    #### concurrent runs write the csv files of their areas to their own folders
+    params['INPUT_CSV_FOLDER'] = f"{path_results}/{request_id}/csv"
+    #### each run opens the input files itself, layers are not thread safe and are never shared between runs
+    params.update(LAYERS)
+    try:
+        result = processing.run(SuitabilityAnalysis(), params, feedback=feedback)
+        feedback.events.put({'result': {key: str(value) for key, value in result.items()}})
+    except Exception as e:
+        feedback.events.put({'error': str(e)})
+    finally:
+        feedback.events.put(None)
+
+
+class AnalysisHandler(BaseHTTPRequestHandler):
+    def send_event(self, event):
+        self.wfile.write((json.dumps(event) + "\n").encode('utf-8'))
+        self.wfile.flush()
+
+    def do_POST(self):
+        if self.path != '/run':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_error(400, "The request must be a JSON object")
+            return
+        if not isinstance(request, dict):
+            self.send_error(400, "The request must be a JSON object")
+            return
+        unknown = [key for key in request if key not in VARIABLE_INPUTS + OUTPUT_INPUTS]
+        if unknown:
+            self.send_error(400, f"Unknown parameters: {unknown}")
+            return
+
+        request_id = next(request_ids)
+        events = queue.Queue()
+        events.put({'queued': request_id})
+        feedback = StreamingFeedback(events)
+        executor.submit(run_analysis, request_id, request, feedback)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        connected = True
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            if not connected:
+                continue
+            try:
+                self.send_event(event)
+            except (BrokenPipeError, ConnectionResetError):
+                #### the client is gone, stop the run
+                connected = False
+                feedback.cancel()
+
+
+if __name__ == "__main__":
+    #### the path to the project is set
+    QgsApplication.setPrefixPath(path_app, True)
+    #### QGX app is stored as variable
+    qgs = QgsApplication([], False)
+    #### Initialize app
+    qgs.initQgis()
+    #### Processing
+    from processing.core.Processing import Processing
+    import processing
+    Processing.initialize()
+    project = QgsProject.instance()
+    project.read(path_project)
+
+    #### the algorithm reads the project home path, so it is imported after the project
+    from suitability_analysis import SuitabilityAnalysis
+
+    #### check the input layers once and build their on-disk spatial indexes, the runs get the file paths
+    LAYERS = {}
+    for layer_params in layers:
+        layer = QgsVectorLayer(layer_params['fn_in'], layer_params['name'], "ogr")
+        if not layer.isValid():
+            raise SystemExit(f"{layer_params['fn_in']} layer failed to load!")
+        if layer.hasSpatialIndex() != QgsFeatureSource.SpatialIndexPresent:
+            processing.run("native:createspatialindex", {'INPUT': layer})
+        LAYERS[layer_params['input']] = layer_params['fn_in']
+        print(f"{layer_params['name']} checked, features: {layer.featureCount()}")
+
+    #### only the variables and the output can be set by the requests, the csv folder is set per request
+    VARIABLE_INPUTS = [value['input'] for value in SuitabilityAnalysis.VAR_PARAMS.values() if value['input'] != 'INPUT_CSV_FOLDER']
+    OUTPUT_INPUTS = [value['output'] for value in SuitabilityAnalysis.OUTPUT_PARAMS.values()]
+
+    if not os.path.exists(path_results):
+        os.makedirs(path_results)
+
+    executor = ThreadPoolExecutor(max_workers=WORKERS)
+    request_ids = itertools.count(1)
+
+    print(f"Analysis server listening on http://{SERVER_ADDRESS[0]}:{SERVER_ADDRESS[1]}/run")
+    server = ThreadingHTTPServer(SERVER_ADDRESS, AnalysisHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        executor.shutdown()
+        #### remove the provider and layer registries from memory
+        qgs.exitQgis()
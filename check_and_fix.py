@@ -8,12 +8,20 @@ from qgis.core import (
     QgsApplication,
     QgsVectorLayer,
     QgsVectorFileWriter,
+    Qgis,
 
 )
 
 ####################################################################
 import os
 
+#### fixed precision grid in the layer units, e.g. 0.01 for 1 cm in a projected CRS
+#### when set, the layers are snapped to the grid instead of the whole layer check and fix
+GRID_SIZE = 0
+#### when set, the features are written sorted by the Hilbert curve key of their centroids, stored in the HILBERT field,
+#### so spatially adjacent features are adjacent in the file
+HILBERT_ORDER = False
+
 def check_and_fix(layer_params):
     layer = QgsVectorLayer(layer_params['fn_in'], layer_params['name'] , "ogr")
     if not layer.isValid():
@@ -41,6 +49,15 @@ def check_and_fix(layer_params):
         print(f"Errors in layer: 0")
     return layer
 
+def snap_to_grid(layer_params, grid_size):
+    layer = QgsVectorLayer(layer_params['fn_in'], layer_params['name'] , "ogr")
+    if not layer.isValid():
+        print(f"{layer_params['fn_in']} layer failed to load!")
+    #### snap the vertices and repair only the features broken by snapping, the same way as the analysis does
+    layer, repaired, dropped = snap_layer_to_grid(layer, grid_size)
+    print(f"Snapped to grid {grid_size}, repaired features: {repaired}, collapsed and dropped: {len(dropped)}")
+    return layer
+
 #### paths
 path_app = "C:\Program Files\QGIS 3.16.9"
 path_project = './FinalQGIS/FinalProject.qgz'
@@ -57,6 +74,11 @@ qgs.initQgis()
 #### Processing
 Processing.initialize()
 
+#### the algorithm reads the project home path, so it is imported after the project
+from suitability_analysis import snap_layer_to_grid, hilbert_sorted, GRID_SIZE_MIN_VERSION
+if GRID_SIZE and Qgis.QGIS_VERSION_INT < GRID_SIZE_MIN_VERSION:
+    print(f"WARNING: QGIS {Qgis.QGIS_VERSION} ignores the grid in the overlays, the snapped layers are not kept valid by the analysis. QGIS 3.28 or later is required")
+
 layers = [
     #### EXISTING FROG HABITAT
     {
@@ -101,8 +123,14 @@ for layer_params in layers:
     layer = QgsVectorLayer(layer_params['fn_out'], layer_params['name'] , "ogr")
     if not layer.isValid():
         print(f"{layer_params['fn_out']} OUT layer failed to load! Checking and Repairing the file")
-        layer = check_and_fix(layer_params)
+        if GRID_SIZE:
+            layer = snap_to_grid(layer_params, GRID_SIZE)
+        else:
+            layer = check_and_fix(layer_params)
     else:
         print(f"{layer_params['fn_out']} OUT layer is fixed already")
+    if HILBERT_ORDER:
+        layer = hilbert_sorted(layer)
+        print(f"Sorted along the Hilbert curve, features: {layer.featureCount()}")
     QgsVectorFileWriter.writeAsVectorFormat(layer, layer_params['fn_out'], 'utf-8', driverName='ESRI Shapefile')
     print('*'*30)
\ No newline at end of file
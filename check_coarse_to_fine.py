@@ -0,0 +1,130 @@
+import os
+import sys
+import pandas as pd
+from qgis.core import (
+    QgsProject,
+    QgsApplication,
+    QgsVectorLayer,
+    QgsSpatialIndex,
+)
+
+####################################################################
+#### Coarse-to-fine check.
+#### the analysis is run on the sample data without and with the coarse pass, the selected areas, their targets, shares,
+#### geometries and the csv files of both runs must be the same. The coarse pass numbers the areas by their position,
+#### so the areas of the runs are paired by their geometry
+
+#### paths
+path_app = "C:\Program Files\QGIS 3.16.9"
+path_project = './FinalQGIS/FinalProject.qgz'
+path_results = './FinalQGIS/data/results/coarse_to_fine'
+
+#### coarse pass simplification tolerance as a share of the smallest buffer
+COARSE_FACTOR = 0.5
+#### tolerances of the comparison, the share and the area of the symmetric difference in the layer units
+SHARE_TOLERANCE = 1e-6
+AREA_TOLERANCE = 1e-3
+
+layers = [
+    {'fn_in': "./data/_FIXED_DATA/region.shp", 'input': 'INPUT_ADMIN', 'name': "ADMIN"},
+    {'fn_in': "./data/_FIXED_DATA/hydro.shp", 'input': 'INPUT_HYDRO', 'name': "HYDROLOGY"},
+    {'fn_in': "./data/_FIXED_DATA/plan_zone.shp", 'input': 'INPUT_ZONES', 'name': "PLAN_ZONES"},
+    {'fn_in': "./data/_FIXED_DATA/vegetation.shp", 'input': 'INPUT_VEG', 'name': "VEGETATION"}
+]
+
+
+def run(name, coarse_factor):
+    if not os.path.exists(f"{path_results}/{name}"):
+        os.makedirs(f"{path_results}/{name}")
+    params = {
+        'INPUT_COARSE': coarse_factor,
+        'INPUT_CSV_FOLDER': f"{path_results}/{name}/csv",
+        'OUTPUT_LAYER_1': f"{path_results}/{name}/output.gpkg"
+    }
+    for layer_params in layers:
+        layer = QgsVectorLayer(layer_params['fn_in'], layer_params['name'], "ogr")
+        if not layer.isValid():
+            raise SystemExit(f"{layer_params['fn_in']} layer failed to load!")
+        params[layer_params['input']] = layer
+    result = processing.run(SuitabilityAnalysis(), params)
+    output = QgsVectorLayer(result['OUTPUT_LAYER_1'], name, "ogr")
+    features = list(output.getFeatures())
+    print(f"{name}: {len(features)} selected areas")
+    return features, params['INPUT_CSV_FOLDER']
+
+
+def compare(exact, coarse):
+    #### pairs the OBJECTID of the exact areas with the ones of the same geometry in the coarse-to-fine output
+    mismatches = []
+    ids = {}
+    index = QgsSpatialIndex(flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+    coarse_features = {}
+    for i, f in enumerate(coarse):
+        index.addFeature(i, f.geometry().boundingBox())
+        coarse_features[i] = f
+    paired = set()
+    for f in exact:
+        geometry = f.geometry()
+        match = None
+        for i in index.intersects(geometry.boundingBox()):
+            other = coarse_features[i]
+            if i not in paired and other['TARGET'] == f['TARGET'] and geometry.symDifference(other.geometry()).area() <= AREA_TOLERANCE:
+                match = i
+                break
+        if match is None:
+            mismatches.append(f"area {f['OBJECTID']} {f['TARGET']} is missing in the coarse-to-fine output")
+            continue
+        paired.add(match)
+        other = coarse_features[match]
+        ids[f['OBJECTID']] = other['OBJECTID']
+        if abs(f['TARGET_PERC'] - other['TARGET_PERC']) > SHARE_TOLERANCE:
+            mismatches.append(f"area {f['OBJECTID']} {f['TARGET']} share {f['TARGET_PERC']} != {other['TARGET_PERC']}")
+    for i, other in coarse_features.items():
+        if i not in paired:
+            mismatches.append(f"area {other['OBJECTID']} {other['TARGET']} of the coarse-to-fine output is not in the exact output")
+    return mismatches, ids
+
+
+def compare_csv(exact_folder, coarse_folder, ids):
+    mismatches = []
+    for exact_id, coarse_id in sorted(ids.items()):
+        exact_fn = f"{exact_folder}/vegetation_stats_area_{exact_id}.csv"
+        coarse_fn = f"{coarse_folder}/vegetation_stats_area_{coarse_id}.csv"
+        if not os.path.exists(exact_fn) or not os.path.exists(coarse_fn):
+            mismatches.append(f"csv of area {exact_id} ({coarse_id}) is missing in one of the outputs")
+            continue
+        try:
+            pd.testing.assert_frame_equal(pd.read_csv(exact_fn), pd.read_csv(coarse_fn), check_exact=False, atol=AREA_TOLERANCE)
+        except AssertionError as e:
+            mismatches.append(f"csv of area {exact_id} ({coarse_id}) differs: {e}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    #### the path to the project is set
+    QgsApplication.setPrefixPath(path_app, True)
+    #### QGX app is stored as variable
+    qgs = QgsApplication([], False)
+    #### Initialize app
+    qgs.initQgis()
+    #### Processing
+    from processing.core.Processing import Processing
+    import processing
+    Processing.initialize()
+    project = QgsProject.instance()
+    project.read(path_project)
+
+    #### the algorithm reads the project home path, so it is imported after the project
+    from suitability_analysis import SuitabilityAnalysis
+
+    exact, exact_folder = run("exact", 0)
+    coarse, coarse_folder = run("coarse", COARSE_FACTOR)
+    mismatches, ids = compare(exact, coarse)
+    mismatches += compare_csv(exact_folder, coarse_folder, ids)
+    for mismatch in mismatches:
+        print(mismatch)
+    print(f"{len(mismatches)} mismatches between the exact and the coarse-to-fine output")
+
+    #### remove the provider and layer registries from memory
+    qgs.exitQgis()
+    sys.exit(1 if mismatches else 0)
@@ -2,74 +2,50 @@ from pandas.core.algorithms import isin
 from processing.core.Processing import Processing
 import pandas as pd
 import os
+from concurrent.futures import ThreadPoolExecutor
 from qgis.core import (
     QgsProject,
     QgsApplication,
     QgsVectorLayer,
     QgsVectorFileWriter,
     QgsVectorLayer,
-    QgsWkbTypes,
-    QgsField,
-    QgsExpression,
-    QgsExpressionContext,
-    QgsExpressionContextUtils,
-    QgsProject
+    QgsProject,
+    QgsFeatureRequest,
+    QgsFeatureSource,
+    QgsGeometry,
+    QgsCoordinateTransform
 )
 
-from PyQt5.QtCore import QVariant
 from qgis import processing
 
 ####################################################################
-def attributes_to_df(layer):
-    cols = [field.name() for field in layer.fields()]
-    row_list = [dict(zip(cols, feat.attributes())) for feat in layer.getFeatures()]
-    df = pd.DataFrame(row_list, columns=cols)
-    # print(f"attributes to df length: {len(df)}")
-    return df
-
-def add_shape_area(layer, field_names={'area': 'Shape_Area', 'length': 'Shape_Leng'}):
-    geom = layer.geometryType()
-    try:
-        area = field_names['area']
-    except:
-        area = 'Shape_Area'
-
-    try:
-        length = field_names['length']
-    except:
-        length = 'Shape_Leng'
-
-    prov = layer.dataProvider()
-    attr_names = [field.name() for field in prov.fields()]
-    #### add if the field doesn't exist
-    if area not in attr_names:
-        layer.startEditing()
-        prov.addAttributes([QgsField(area, QVariant.Double)])
-        attr_names = [field.name() for field in prov.fields()]
-        layer.commitChanges()
-
-    if length not in attr_names:
-        layer.startEditing()
-        prov.addAttributes([QgsField(length, QVariant.Double)])
-        attr_names = [field.name() for field in prov.fields()]
-        layer.commitChanges()
-
-    layer.startEditing()
-    expression_a = QgsExpression('$area')
-    if geom == QgsWkbTypes.PolygonGeometry:
-        expression_l = QgsExpression('$perimeter')
-    else:
-        expression_l = QgsExpression('$length')
-
-    context = QgsExpressionContext()
-    context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
-    for f in layer.getFeatures():
-        context.setFeature(f)
-        f[area] = expression_a.evaluate(context)
-        f[length] = expression_l.evaluate(context)
-        layer.updateFeature(f)
-    layer.commitChanges()
-    return layer
+def habitat_composition(habitat_parts, source, layer, field):
+    """ area totals of the layer features by field inside the habitat parts. 
+    Only the features intersecting each part are read through the spatial index, clipped and measured one by one,
+    the clipped layer is never materialized. Areas are planimetric in the layer units, as $area of the clipped layers was """
+    to_layer = QgsCoordinateTransform(frog_layer.crs(), layer.crs(), project)
+    totals = {}
+    for part in habitat_parts:
+        part = QgsGeometry(part)
+        part.transform(to_layer)
+        engine = QgsGeometry.createGeometryEngine(part.constGet())
+        engine.prepareGeometry()
+        for feat in source.getFeatures(QgsFeatureRequest().setFilterRect(part.boundingBox())):
+            geometry = feat.geometry()
+            if not engine.intersects(geometry.constGet()):
+                continue
+            if not engine.contains(geometry.constGet()):
+                geometry = geometry.intersection(part)
+            totals[feat[field]] = totals.get(feat[field], 0) + geometry.area()
+    return totals
+
+def composition(layer, field):
+    """ totals for the whole habitat and per ASI_TYPE, computed in parallel """
+    if layer.dataProvider().hasSpatialIndex() != QgsFeatureSource.SpatialIndexPresent:
+        layer.dataProvider().createSpatialIndex()
+    with ThreadPoolExecutor() as executor:
+        futures = {asi_type: executor.submit(habitat_composition, parts, layer.dataProvider().featureSource(), layer, field) for asi_type, parts in habitat_parts.items()}
+        return {asi_type: future.result() for asi_type, future in futures.items()}
 
 #### paths
 path_app = "C:\Program Files\QGIS 3.16.9"
@@ -111,91 +87,79 @@ if not frog_layer.isValid():
         QgsVectorFileWriter.writeAsVectorFormat(frog_layer, frog_layer_params['fn_out'], 'utf-8', driverName='ESRI Shapefile')
 print(f"features in dissolved frog layer: {len([x for x in frog_layer.getFeatures()])}")
 
+####################################################################
+#### HABITAT PARTS
+#### the parts of the dissolved habitat by ASI_TYPE, and of the whole habitat for the totals so overlapping types are counted once
+habitat_parts = {}
+for feat in frog_layer.getFeatures():
+    habitat_parts[feat['ASI_TYPE']] = feat.geometry().asGeometryCollection()
+habitat_parts[None] = QgsGeometry.unaryUnion([feat.geometry() for feat in frog_layer.getFeatures()]).asGeometryCollection()
+
 ####################################################################
 #### VEGETATION MAP
 veg_layer_params = {
     'fn_in': "./data/_FIXED_DATA/vegetation.shp",   
-    'fn_out': './FinalQGIS/data/vegetation_existing_habitat.shp',
-    'name': "VEGETATION_EXISTING_HABITAT"
+    'fn_out': 'vegetation_existing_habitat.csv',
+    'fn_out_types': 'vegetation_existing_habitat_asi_types.csv',
+    'name': "VEGETATION"
     }
-#### CLIP BY EXISTING FROG HABITAT
-veg_layer = QgsVectorLayer(veg_layer_params['fn_out'], veg_layer_params['name'] , "ogr")
+veg_layer = QgsVectorLayer(veg_layer_params['fn_in'], veg_layer_params['name'] , "ogr")
 if not veg_layer.isValid():
-    print(f"{veg_layer_params['fn_out']} layer failed to load!")
-    veg_layer = QgsVectorLayer(veg_layer_params['fn_in'], veg_layer_params['name'] , "ogr")
-    if not veg_layer.isValid():
-        print(f"{veg_layer_params['fn_in']} layer failed to load!")
-    else:
-        params = {
-            'INPUT':veg_layer,
-            'OVERLAY':frog_layer,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }
-        veg_layer = processing.run("native:clip", params)['OUTPUT']
-        QgsVectorFileWriter.writeAsVectorFormat(veg_layer, veg_layer_params['fn_out'], 'utf-8', driverName='ESRI Shapefile')
-#### ADD ATTRIBUTE AREA AND CALCULATE
-add_shape_area(veg_layer)
-QgsVectorFileWriter.writeAsVectorFormat(veg_layer, veg_layer_params['fn_out'], 'utf-8', driverName='ESRI Shapefile')
-
-# veg_layer = QgsVectorLayer(veg_layer_params['fn_out'], veg_layer_params['name'] , "ogr")
-print(f"features in veg existing habitat layer: {len([x for x in veg_layer.getFeatures()])}")
-
-#### CALCULATE PERCENTAGE
-df = attributes_to_df(veg_layer)
-df = df[['NVISDSC1', 'Shape_Area']]
-df['NVIS_ID'] = df['NVISDSC1']
+    print(f"{veg_layer_params['fn_in']} layer failed to load!")
+#### AREA BY VEGETATION CODE INSIDE EXISTING FROG HABITAT
+veg_totals = composition(veg_layer, 'NVISDSC1')
 
 veg_class_df = pd.read_csv("./data/_VEGETATION/FGDB_VIC_EXT/NVIS_6_0_LUT_AUST_FLAT/NVIS6_0_LUT_AUST_FLAT.csv")
 # print(f"veg_class_df length {len(veg_class_df.index)}")
 
-df = df.merge(veg_class_df, on='NVIS_ID', how='left')
-df = df.groupby(['MVS_NAME'], as_index=False).agg({'Shape_Area':'sum', 'NVIS_ID': set})
-df = df.loc[df["MVS_NAME"] != "Cleared, non-native vegetation, buildings"]
+#### CALCULATE PERCENTAGE
+def veg_percent(totals):
+    df = pd.DataFrame(list(totals.items()), columns=['NVIS_ID', 'Shape_Area'])
+    df = df.merge(veg_class_df, on='NVIS_ID', how='left')
+    df = df.groupby(['MVS_NAME'], as_index=False).agg({'Shape_Area':'sum', 'NVIS_ID': set})
+    df = df.loc[df["MVS_NAME"] != "Cleared, non-native vegetation, buildings"]
+
+    df['percent'] = (df['Shape_Area'] / df['Shape_Area'].sum()) * 100
+    df = df.sort_values(by=['percent'], ascending=False)
+    return df
 
-df['percent'] = (df['Shape_Area'] / df['Shape_Area'].sum()) * 100
-df = df.sort_values(by=['percent'], ascending=False)
+df = veg_percent(veg_totals[None])
 # print(df)
-df.to_csv('vegetation_existing_habitat.csv', index=False)
+df.to_csv(veg_layer_params['fn_out'], index=False)
+
+types_df = [veg_percent(totals).assign(ASI_TYPE=asi_type) for asi_type, totals in veg_totals.items() if asi_type is not None]
+pd.concat(types_df).to_csv(veg_layer_params['fn_out_types'], index=False)
 
 ####################################################################
 #### HYDROLOGY MAP
 hydro_layer_params = {
     'fn_in': "./data/_FIXED_DATA/hy_water_area_polygon.shp",
-    'fn_out': './FinalQGIS/data/hydro_existing_habitat.shp',
-    'name': "HYDROLOGY_EXISTING_HABITAT"
+    'fn_out': 'hydro_existing_habitat.csv',
+    'fn_out_types': 'hydro_existing_habitat_asi_types.csv',
+    'name': "HYDROLOGY"
 }
-#### CLIP BY EXISTING FROG HABITAT
-hydro_layer = QgsVectorLayer(hydro_layer_params['fn_out'], hydro_layer_params['name'] , "ogr")
+hydro_layer = QgsVectorLayer(hydro_layer_params['fn_in'], hydro_layer_params['name'] , "ogr")
 if not hydro_layer.isValid():
-    print(f"{hydro_layer_params['fn_out']} layer failed to load!")
-    hydro_layer = QgsVectorLayer(hydro_layer_params['fn_in'], hydro_layer_params['name'] , "ogr")
-    if not hydro_layer.isValid():
-        print(f"{hydro_layer_params['fn_in']} layer failed to load!")
-    else:
-        params = {
-            'INPUT':hydro_layer,
-            'OVERLAY':frog_layer,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }
-        hydro_layer = processing.run("native:clip", params)['OUTPUT']
-        QgsVectorFileWriter.writeAsVectorFormat(hydro_layer, hydro_layer_params['fn_out'], 'utf-8', driverName='ESRI Shapefile')
-
-#### ADD ATTRIBUTE AREA AND CALCULATE
-add_shape_area(hydro_layer)
-QgsVectorFileWriter.writeAsVectorFormat(hydro_layer, hydro_layer_params['fn_out'], 'utf-8', driverName='ESRI Shapefile')
-print(f"features in hydro existing habitat layer: {len([x for x in hydro_layer.getFeatures()])}")
+    print(f"{hydro_layer_params['fn_in']} layer failed to load!")
+#### AREA BY WATER TYPE INSIDE EXISTING FROG HABITAT
+hydro_totals = composition(hydro_layer, 'FTYPE_CODE')
 
 #### CALCULATE PERCENTAGE
-df = attributes_to_df(hydro_layer)
-print(df)
-df = df.groupby(['FTYPE_CODE'], as_index=False).agg({'Shape_Area':'sum'})
-df['percent'] = (df['Shape_Area'] / df['Shape_Area'].sum()) * 100
-df = df.sort_values(by=['percent'], ascending=False)
+def hydro_percent(totals):
+    df = pd.DataFrame(list(totals.items()), columns=['FTYPE_CODE', 'Shape_Area'])
+    df['percent'] = (df['Shape_Area'] / df['Shape_Area'].sum()) * 100
+    df = df.sort_values(by=['percent'], ascending=False)
+    return df
+
+df = hydro_percent(hydro_totals[None])
 print(df)
-df.to_csv('hydro_existing_habitat.csv', index=False)
+df.to_csv(hydro_layer_params['fn_out'], index=False)
+
+types_df = [hydro_percent(totals).assign(ASI_TYPE=asi_type) for asi_type, totals in hydro_totals.items() if asi_type is not None]
+pd.concat(types_df).to_csv(hydro_layer_params['fn_out_types'], index=False)
 
 #### ADD TO PROJECT
-project.addMapLayers([frog_layer, veg_layer, hydro_layer], True)
+project.addMapLayers([frog_layer], True)
 # project.addMapLayers([hydro_layer], True)
 #### SAVE THE PROJECT
 project.write()
@@ -11,9 +11,10 @@
 ***************************************************************************
 """
 
-from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtCore import QCoreApplication, Qt
 from qgis.core import (QgsProcessing,
     QgsFeatureSink,
+    QgsProcessingFeedback,
     QgsProcessingException,
     QgsProcessingAlgorithm,
     QgsProcessingParameterFeatureSource,
@@ -21,19 +22,342 @@ from qgis.core import (QgsProcessing,
     QgsProcessingParameterVectorDestination,
     QgsProcessingParameterNumber,
     QgsProcessingParameterString,
+    QgsProcessingParameterBoolean,
     QgsVectorLayer,
+    QgsVectorFileWriter,
+    QgsGeometry,
+    QgsSpatialIndex,
+    QgsFeature,
+    QgsFields,
+    QgsFeatureRequest,
+    QgsCoordinateTransform,
+    QgsCoordinateReferenceSystem,
+    QgsDistanceArea,
+    QgsRectangle,
+    QgsUnitTypes,
+    QgsProcessingUtils,
     QgsWkbTypes,
     QgsField,
     QgsExpression,
     QgsExpressionContext,
     QgsExpressionContextUtils,
-    QgsProject
+    QgsProject,
+    QgsApplication,
+    Qgis,
+    NULL
 )
 
 from PyQt5.QtCore import QVariant
 import pandas as pd
+import numpy as np
 import os
+import uuid
+import threading
+import hashlib
+import heapq
+from collections import OrderedDict
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from qgis import processing
+from osgeo import gdal
+
+
+class PackedLayer:
+    """
+    Columnar copy of a layer that worker threads and processes attach to without pickling or copying the features.
+    The geometries are one WKB byte buffer with an offsets array, the attributes are NumPy columns (text as category codes)
+    and the bounding boxes an (n, 4) array. The arrays are kept in shared memory, or in memory-mapped files when a folder
+    is given, and only the small descriptor is passed to the workers. Unshared, the descriptor holds the arrays themselves for threads.
+    """
+    def __init__(self, descriptor, owned=None):
+        self.descriptor = descriptor
+        #### the blocks created by the owner stay open until unlink, on Windows a block is freed with its last handle
+        self.owned = owned or []
+        owned_blocks = {block.name: block for block in self.owned}
+        self.blocks = []
+        self.arrays = {}
+        for name, (location, dtype, shape) in descriptor['arrays'].items():
+            if descriptor['backend'] == 'memory':
+                array = location
+            elif location is None:
+                array = np.zeros(shape, dtype=dtype)
+            elif descriptor['backend'] == 'mmap':
+                array = np.memmap(location, dtype=dtype, mode='r', shape=shape)
+            elif location in owned_blocks:
+                array = np.ndarray(shape, dtype=dtype, buffer=owned_blocks[location].buf)
+            else:
+                block = shared_memory.SharedMemory(name=location)
+                if multiprocessing.parent_process() is not None:
+                    #### a worker process only attaches, the owner unlinks the block
+                    resource_tracker.unregister(block._name, 'shared_memory')
+                self.blocks.append(block)
+                array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            self.arrays[name] = array
+
+    @classmethod
+    def from_layer(cls, layer, field_names, path=None, shared=True):
+        wkbs = []
+        bboxes = []
+        columns = {name: [] for name in field_names}
+        for f in layer.getFeatures():
+            geometry = f.geometry()
+            wkbs.append(bytes(geometry.asWkb()))
+            box = geometry.boundingBox()
+            bboxes.append((box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()))
+            for name in field_names:
+                value = f[name]
+                columns[name].append(None if value == NULL else value)
+
+        data = {
+            'wkb': np.frombuffer(b''.join(wkbs), dtype=np.uint8),
+            'offsets': np.cumsum([0] + [len(x) for x in wkbs], dtype=np.int64),
+            'bbox': np.array(bboxes, dtype=np.float64).reshape(-1, 4)
+        }
+        categories = {}
+        for name in field_names:
+            if layer.fields().field(name).isNumeric():
+                data[name] = np.array([np.nan if x is None else x for x in columns[name]], dtype=np.float64)
+            else:
+                values = [None if x is None else str(x) for x in columns[name]]
+                categories[name] = sorted(set(values), key=lambda x: (x is None, x or ''))
+                codes = {x: i for i, x in enumerate(categories[name])}
+                data[name] = np.array([codes[x] for x in values], dtype=np.int32)
+
+        descriptor = {
+            'backend': 'mmap' if path else 'shm' if shared else 'memory',
+            'arrays': {},
+            'categories': categories,
+            'wkb_type': int(layer.wkbType()),
+            'crs': layer.crs().authid()
+        }
+        owned = []
+        for name, array in data.items():
+            location = None
+            if descriptor['backend'] == 'memory':
+                location = array
+            elif array.size and path:
+                location = os.path.join(path, f"{name}.bin")
+                target = np.memmap(location, dtype=array.dtype, mode='w+', shape=array.shape)
+                target[:] = array
+                target.flush()
+                del target
+            elif array.size:
+                block = shared_memory.SharedMemory(create=True, size=array.nbytes)
+                location = block.name
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+                owned.append(block)
+            descriptor['arrays'][name] = (location, array.dtype.str, array.shape)
+        return cls(descriptor, owned)
+
+    def __len__(self):
+        return len(self.arrays['offsets']) - 1
+
+    def geometry(self, i):
+        offsets = self.arrays['offsets']
+        geometry = QgsGeometry()
+        geometry.fromWkb(self.arrays['wkb'][offsets[i]:offsets[i + 1]].tobytes())
+        return geometry
+
+    def values(self, name, indices):
+        column = self.arrays[name][np.asarray(indices, dtype=np.int64)]
+        if name in self.descriptor['categories']:
+            categories = self.descriptor['categories'][name]
+            return [categories[code] for code in column]
+        return column
+
+    def bbox_candidates(self, box):
+        """ indices of the features whose bounding box intersects the QgsRectangle """
+        b = self.arrays['bbox']
+        mask = (b[:, 0] <= box.xMaximum()) & (b[:, 2] >= box.xMinimum()) & (b[:, 1] <= box.yMaximum()) & (b[:, 3] >= box.yMinimum())
+        return np.nonzero(mask)[0]
+
+    def to_layer(self, name="packed"):
+        wkb_type = QgsWkbTypes.displayString(self.descriptor['wkb_type'])
+        layer = QgsVectorLayer(f"{wkb_type}?crs={self.descriptor['crs']}", name, "memory")
+        field_names = [x for x in self.arrays if x not in ['wkb', 'offsets', 'bbox']]
+        layer.dataProvider().addAttributes([QgsField(x, QVariant.String if x in self.descriptor['categories'] else QVariant.Double) for x in field_names])
+        layer.updateFields()
+        indices = range(len(self))
+        columns = [self.values(x, indices) for x in field_names]
+        features = []
+        for i in indices:
+            feature = QgsFeature(layer.fields())
+            feature.setGeometry(self.geometry(i))
+            feature.setAttributes([None if isinstance(column[i], float) and np.isnan(column[i]) else column[i] for column in columns])
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        return layer
+
+    def close(self):
+        #### the array views must be released before the blocks are closed
+        self.arrays = {}
+        for block in self.blocks:
+            block.close()
+        self.blocks = []
+
+    def unlink(self):
+        """ removes the backing shared memory or files, called once by the owner after all workers are done """
+        self.close()
+        for block in self.owned:
+            block.close()
+            block.unlink()
+        self.owned = []
+        if self.descriptor['backend'] == 'mmap':
+            for location, dtype, shape in self.descriptor['arrays'].values():
+                if location is not None:
+                    os.remove(location)
+
+
+def packed_area_stats(descriptor, shard, targets):
+    """
+    Vegetation statistics of the areas in the shard computed on the packed pieces, with the (target, share) pairs
+    of the targets present in each area at their minimum share. The statistics are None where no target is present.
+    It is a module function so it can run in worker processes as well as threads.
+    """
+    pieces = PackedLayer(descriptor)
+    try:
+        stats = []
+        for number, area_id, area_wkb in shard:
+            area_geometry = QgsGeometry()
+            area_geometry.fromWkb(area_wkb)
+            engine = QgsGeometry.createGeometryEngine(area_geometry.constGet())
+            engine.prepareGeometry()
+            #### collect all parts of each dissolved area and convert attribures to df
+            parts = []
+            for i in pieces.bbox_candidates(area_geometry.boundingBox()):
+                geometry = pieces.geometry(i)
+                if engine.intersects(geometry.constGet()):
+                    parts.append(i)
+            df = pd.DataFrame({'MVS_NAME': pieces.values('MVS_NAME', parts), 'Shape_Area': pieces.values('Shape_Area', parts)})
+
+            #### get stats on vegetation once and evaluate all targets on them
+            veg_sum_df = df.groupby(['MVS_NAME']).agg({'Shape_Area': 'sum'})
+            veg_sum_df['veg_perc'] = veg_sum_df['Shape_Area'] / veg_sum_df['Shape_Area'].sum()
+            matched = match_targets(veg_sum_df, targets)
+            stats.append((number, area_id, veg_sum_df if matched else None, matched))
+        return stats
+    finally:
+        pieces.close()
+
+
+def raster_area_stats(raster_stats, shard, targets):
+    """
+    Same as packed_area_stats, on the vegetation statistics computed from the gridded NVIS raster.
+    """
+    stats = []
+    for number, area_id, area_wkb in shard:
+        veg_sum_df = raster_stats.get(number)
+        matched = match_targets(veg_sum_df, targets) if veg_sum_df is not None else []
+        stats.append((number, area_id, veg_sum_df if matched else None, matched))
+    return stats
+
+
+def match_targets(veg_sum_df, targets):
+    """
+    (target, share) pairs of the targets present in the vegetation statistics at their minimum share.
+    """
+    #### select areas where "Temperate tussock grasslands" or the other targets are present    
+    matched = []
+    for target, min_share in targets:
+        if target in veg_sum_df.index and veg_sum_df.loc[target, 'veg_perc'] >= min_share:
+            matched.append((target, veg_sum_df.loc[target, 'veg_perc']))
+    return matched
+
+
+#### the overlays take a GRID_SIZE only from QGIS 3.28, older versions silently ignore it
+GRID_SIZE_MIN_VERSION = 32800
+
+
+def snap_layer_to_grid(layer, grid_size, feedback=None):
+    """
+    in-memory copy of the layer with the vertices snapped to the grid. Only the features broken by snapping are repaired,
+    the ones that collapse or are repaired to another geometry type are dropped. Returns the layer, the repaired count and the dropped ids.
+    """
+    layer = layer.materialize(QgsFeatureRequest())
+    geometry_type = layer.geometryType()
+    changes = {}
+    dropped = []
+    repaired = 0
+    for f in layer.getFeatures():
+        if feedback is not None and feedback.isCanceled():
+            break
+        geometry = f.geometry().snappedToGrid(grid_size, grid_size)
+        if not geometry.isGeosValid():
+            #### makeValid can return a collection, or parts of lower dimension
+            geometry = geometry.makeValid()
+            geometry.convertGeometryCollectionToSubclass(geometry_type)
+            repaired += 1
+        if geometry.isEmpty() or geometry.type() != geometry_type:
+            dropped.append(f.id())
+            continue
+        if QgsWkbTypes.isMultiType(layer.wkbType()):
+            geometry.convertToMultiType()
+        changes[f.id()] = geometry
+    layer.dataProvider().changeGeometryValues(changes)
+    layer.dataProvider().deleteFeatures(dropped)
+    return layer, repaired, dropped
+
+
+def hilbert_key(x, y, extent, order=16):
+    """
+    position of the point (x, y) along the Hilbert curve of 2^order x 2^order cells over the QgsRectangle extent.
+    """
+    n = 1 << order
+    px = min(n - 1, max(0, int((x - extent.xMinimum()) / (extent.width() or 1) * n)))
+    py = min(n - 1, max(0, int((y - extent.yMinimum()) / (extent.height() or 1) * n)))
+    key = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if px & s else 0
+        ry = 1 if py & s else 0
+        key += s * s * ((3 * rx) ^ ry)
+        #### rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                px = n - 1 - px
+                py = n - 1 - py
+            px, py = py, px
+        s >>= 1
+    return key
+
+
+def hilbert_sorted(layer, name=None):
+    """
+    memory copy of the layer sorted by the Hilbert curve key of the feature centroids over the layer extent, the key is stored in the HILBERT field.
+    """
+    extent = layer.extent()
+    keyed = []
+    for f in layer.getFeatures():
+        geometry = f.geometry()
+        point = geometry.centroid().asPoint() if not geometry.isEmpty() else extent.center()
+        keyed.append((hilbert_key(point.x(), point.y(), extent), f))
+    keyed.sort(key=lambda x: x[0])
+
+    fields = QgsFields(layer.fields())
+    if 'HILBERT' not in fields.names():
+        fields.append(QgsField('HILBERT', QVariant.LongLong))
+    result = QgsVectorLayer(f"{QgsWkbTypes.displayString(layer.wkbType())}?crs={layer.crs().authid()}", name or layer.name(), "memory")
+    result.dataProvider().addAttributes(fields)
+    result.updateFields()
+    index = result.fields().indexOf('HILBERT')
+    features = []
+    for key, f in keyed:
+        feature = QgsFeature(result.fields())
+        feature.setGeometry(f.geometry())
+        attributes = f.attributes() + [None] * (len(fields) - len(f.attributes()))
+        attributes[index] = key
+        feature.setAttributes(attributes)
+        features.append(feature)
+    result.dataProvider().addFeatures(features)
+    return result
+
+
+def layer_source(layer):
+    """
+    source of the layer for the cache keys. Copies of a layer made in memory carry the path of their file in the 'source_path' property.
+    """
+    return layer.customProperty('source_path', layer.source())
 
 
 class SuitabilityAnalysis(QgsProcessingAlgorithm):
@@ -53,14 +377,29 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
     2) a 'csv' folder with csv files for each selected area
     
     Note: to reduce the amount of uploaded data the script only unducts the analysis for "SOUTHERN METROPOLITAN" region and all vector layers are already clipped to that area.
+    With windowed reading of the inputs any region can be selected and the statewide layers are used directly.
     """
     ##### SOME PATHS
-    #### project data path
-    data_path = f"{QgsProject.instance().homePath()}/data"
+    #### project data path. The site selection worker processes import the module without a QGIS application,
+    #### they never touch the project, so it is not instantiated there
+    data_path = f"{QgsProject.instance().homePath() if QgsApplication.instance() is not None else '.'}/data"
     ##### path to the table of vegetation codes - names
     veg_table_path = f"{data_path}/NVIS6_0_LUT_AUST_FLAT.csv"
     #### path to create csv files for selected areas
     csv_path = f"{data_path}/csv"
+    #### path to keep materialized intermediate layers between runs
+    cache_path = f"{data_path}/cache"
+    #### inputs windowed to a study area, by source, region and CRS. Kept for the life of the process
+    WINDOW_CACHE = {}
+    #### concurrent runs read the cached windows one at a time, each gets its own copy
+    WINDOW_LOCK = threading.Lock()
+    #### GRASS algorithms share one temporary location and session, they never run concurrently
+    GRASS_LOCK = threading.Lock()
+    #### buffers of single water bodies by the SHA-256 digest of their WKB and distance, built only where pieces are clipped at the distance.
+    #### the least recently used ones are dropped beyond BUFFER_CACHE_SIZE
+    BUFFER_CACHE = OrderedDict()
+    BUFFER_CACHE_SIZE = 20000
+    BUFFER_LOCK = threading.Lock()
 
     """"
     all input parameters settings, as well as input layers and outputs are collected into dictionaries.
@@ -107,10 +446,115 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
         },
         "veg_name" : {
             "parameter": QgsProcessingParameterString,
-            "description": "Input Preferable Vegetation Type",
+            "description": "Input Preferable Vegetation Types, separated by ';' with optional minimum share as 'name:0.1'",
             "input": "INPUT_VEG_NAME",
             "default": "Temperate tussock grasslands",
             "optional": False
+        },
+        "cache_base_overlay" : {
+            "parameter": QgsProcessingParameterBoolean,
+            "description": "Reuse materialized Planning Zones x Vegetation overlay",
+            "input": "INPUT_CACHE_BASE",
+            "default": False,
+            "optional": False
+        },
+        "windowed_inputs" : {
+            "parameter": QgsProcessingParameterBoolean,
+            "description": "Read statewide inputs windowed to the Study Area",
+            "input": "INPUT_WINDOWED",
+            "default": False,
+            "optional": False
+        },
+        "simplify_factor" : {
+            "parameter": QgsProcessingParameterNumber,
+            "type": QgsProcessingParameterNumber.Double,
+            "description": "Input Simplification Tolerance as a share of the smallest Buffer (0 - no simplification)",
+            "input": "INPUT_SIMPLIFY",
+            "default": 0,
+            "minValue": 0,
+            "maxValue": 1,
+            "optional": False
+        },
+        "min_piece_area" : {
+            "parameter": QgsProcessingParameterNumber,
+            "type": QgsProcessingParameterNumber.Double,
+            "description": "Input minimum Piece area after intersections (0 - keep all pieces)",
+            "input": "INPUT_MIN_PIECE",
+            "default": 0,
+            "minValue": 0,
+            "optional": False
+        },
+        "grid_size" : {
+            "parameter": QgsProcessingParameterNumber,
+            "type": QgsProcessingParameterNumber.Double,
+            "description": "Input Fixed Precision Grid Size (0 - floating precision)",
+            "input": "INPUT_GRID_SIZE",
+            "default": 0,
+            "minValue": 0,
+            "optional": False
+        },
+        "top_k" : {
+            "parameter": QgsProcessingParameterNumber,
+            "type": QgsProcessingParameterNumber.Integer,
+            "description": "Input Number of best ranked Sites to keep (0 - all suitable sites)",
+            "input": "INPUT_TOP_K",
+            "default": 0,
+            "minValue": 0,
+            "optional": False
+        },
+        "worker_processes" : {
+            "parameter": QgsProcessingParameterBoolean,
+            "description": "Run Site Selection in Worker Processes (standalone runs only)",
+            "input": "INPUT_WORKER_PROCESSES",
+            "default": False,
+            "optional": False
+        },
+        "water_index" : {
+            "parameter": QgsProcessingParameterBoolean,
+            "description": "Find Water within the Buffer Distance through a nearest neighbour index instead of buffer polygons",
+            "input": "INPUT_WATER_INDEX",
+            "default": False,
+            "optional": False
+        },
+        "veg_raster" : {
+            "parameter": QgsProcessingParameterString,
+            "description": "Input path to gridded NVIS Vegetation raster for the area statistics (optional)",
+            "input": "INPUT_VEG_RASTER",
+            "default": "",
+            "optional": True
+        },
+        "csv_folder" : {
+            "parameter": QgsProcessingParameterString,
+            "description": "Input folder for the csv files of the selected areas (optional, './data/csv' by default)",
+            "input": "INPUT_CSV_FOLDER",
+            "default": "",
+            "optional": True
+        },
+        "hilbert_order" : {
+            "parameter": QgsProcessingParameterBoolean,
+            "description": "Keep windowed and intermediate layers sorted along the Hilbert curve",
+            "input": "INPUT_HILBERT",
+            "default": False,
+            "optional": False
+        },
+        "coarse_factor" : {
+            "parameter": QgsProcessingParameterNumber,
+            "type": QgsProcessingParameterNumber.Double,
+            "description": "Input Coarse Pass Simplification Tolerance as a share of the smallest Buffer (0 - no coarse pass)",
+            "input": "INPUT_COARSE",
+            "default": 0,
+            "minValue": 0,
+            "maxValue": 1,
+            "optional": False
+        },
+        "workers" : {
+            "parameter": QgsProcessingParameterNumber,
+            "type": QgsProcessingParameterNumber.Integer,
+            "description": "Input Number of Parallel Workers",
+            "input": "INPUT_WORKERS",
+            "default": 4,
+            "minValue": 1,
+            "optional": False
         }
     }
     """ 
@@ -224,14 +668,27 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
             - the table of vegetation codes-names association 'NVIS6_0_LUT_AUST_FLAT.csv' must be present in th eproject './data' folder
             -------------------------
             VARIABLES:
-            - Study Area Name, must be set to "SOUTHERN METROPOLITAN"
+            - Study Area Name, must be set to "SOUTHERN METROPOLITAN" unless the inputs are read windowed
             - Buffer Distance from Facilities", default -50. Buffers the Planning Zones INSIDE
             - Buffer Distance from Water, default 100. Buffers the hydrology OUTSIDE
             - minimum Water area required, default": 4500
-            - Preferable Vegetation Type, must be set to "Temperate tussock grasslands"
+            - Preferable Vegetation Types, default "Temperate tussock grasslands". Several types are separated by ';', each can have a minimum share, e.g. "Temperate tussock grasslands:0.2;Eucalyptus woodlands". All of them are evaluated in one pass
+            - Reuse materialized Planning Zones x Vegetation overlay, default False. Saves the overlay to './data/cache' per Study Area and Facilities Buffer and reuses it in later runs
+            - Read statewide inputs windowed to the Study Area, default False. Only the features inside the Study Area are read, reprojected and clipped, and kept in memory for the next runs
+            - Simplification Tolerance as a share of the smallest Buffer, default 0 (no simplification). The area error of the simplification is reported per vegetation type
+            - minimum Piece area after intersections, default 0. Smaller slivers are merged into their largest neighbour, the count and area of removed slivers is reported
+            - Fixed Precision Grid Size, default 0. The inputs are snapped to the grid (e.g. 0.01 for 1 cm) and the overlays run at that precision, so no validity check and fixing is required
+            - Number of best ranked Sites to keep, default 0 (all suitable sites). The sites are ranked by the share of the Preferable Vegetation times the site area
+            - Run Site Selection in Worker Processes, default False. The pieces are shared with the workers through shared memory. The workers re-import the calling script, so it must keep its QGIS and server startup under if __name__ == '__main__', as 'analysis_server.py' does
+            - Find Water through a nearest neighbour index, default False. Pieces far from water are skipped without buffers, buffers are built only to clip pieces at the exact distance and are reused between runs
+            - path to gridded NVIS Vegetation raster, optional. When set, the vegetation statistics of the areas are counted on the raster grid, in m2, instead of the polygon intersection. Areas without a pixel centre inside keep the polygon statistics
+            - folder for the csv files of the selected areas, optional. Default './data/csv'
+            - Keep windowed and intermediate layers sorted along the Hilbert curve, default False. The features are sorted by the Hilbert curve key of their centroids, stored in the HILBERT field, so spatially adjacent features are adjacent in memory. The areas are numbered in that order
+            - Coarse Pass Simplification Tolerance as a share of the smallest Buffer, default 0 (no coarse pass). The areas of the coarse pass are classified as definitely suitable, definitely unsuitable or ambiguous, and the exact pass runs only around the target vegetation near the ones not definitely unsuitable. Its extents are grown until the areas with target vegetation are complete, so the output holds the areas of the one without the coarse pass. The OBJECTID is then the Hilbert curve key of the area over the study area with its rank in the cell, so it does not depend on which other areas were built
+            - Number of Parallel Workers, default 4. Independent branches of the analysis run concurrently
             -------------------------
             OUTPUT:
-            - layer of selected suitable areas
+            - layer of selected suitable areas, one feature per area and target vegetation type found in it (fields TARGET and TARGET_PERC)
             - folder './data/csv' with the vegetation summary for each selected area. the filename is associated with the OBJECTID of the feature in selected layer
 
             """
@@ -276,6 +733,16 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
             )
 
     def processAlgorithm(self, parameters, context, feedback):
+        #### a canceled run ends like the baseline does, with no outputs. The stages stop by raising, a child algorithm
+        #### stopped by the cancel raises as well, so the exceptions of a canceled run are not reported as a failure
+        try:
+            return self.run_analysis(parameters, context, feedback)
+        except QgsProcessingException:
+            if feedback.isCanceled():
+                return {}
+            raise
+
+    def run_analysis(self, parameters, context, feedback):
         ##### define parameters variables locally
         LAYERS_PARAMS = self.LAYERS_PARAMS
         VAR_PARAMS = self.VAR_PARAMS
@@ -287,6 +754,37 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
         ####################################################################
         ##### DEFINE FUNCTIONS
         log = feedback.pushInfo
+        def run_alg(alg_id, params):
+            #### stop between stages, and let the child algorithm check for cancelation inside the stage
+            if feedback.isCanceled():
+                raise QgsProcessingException("The analysis was canceled")
+            child_feedback = QgsProcessingFeedback()
+            #### a direct connection, the stage threads run no event loop that would deliver a queued cancel
+            feedback.canceled.connect(child_feedback.cancel, Qt.DirectConnection)
+            try:
+                if feedback.isCanceled():
+                    child_feedback.cancel()
+                return processing.run(alg_id, params, feedback=child_feedback)
+            finally:
+                feedback.canceled.disconnect(child_feedback.cancel)
+
+        def run_stages(stages, workers):
+            #### run independent stages concurrently in background threads, results are returned by stage name
+            #### the feedback is polled while waiting so a canceled run stops immediately
+            results = {}
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(stage): name for name, stage in stages.items()}
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[futures[future]] = future.result()
+                    if feedback.isCanceled():
+                        for future in pending:
+                            future.cancel()
+                        raise QgsProcessingException("The analysis was canceled")
+            return {name: results[name] for name in stages}
+
         def load_reproject_and_clip(name, layer, mask_layer):
             crs = mask_layer.crs()
             #### REPROJECT
@@ -297,7 +795,7 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
                     'TARGET_CRS': crs.authid(),
                     'OUTPUT': 'TEMPORARY_OUTPUT'
                 }
-                layer = processing.run('native:reprojectlayer', params)['OUTPUT']
+                layer = run_alg('native:reprojectlayer', params)['OUTPUT']
             log(f"layer {name} is in to {crs} projection")
 
             #### CLIP
@@ -305,10 +803,386 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
                 'OVERLAY': mask_layer,
                 'OUTPUT': 'TEMPORARY_OUTPUT'
             }
-            layer = processing.run("native:clip", params)['OUTPUT']
+            layer = run_alg("native:clip", params)['OUTPUT']
             log(f"layer {name} was clipped by study area")
             return layer
 
+        def load_windowed(name, layer, mask_layer):
+            crs = mask_layer.crs()
+            #### the modification time of the source is in the key, so a replaced input file is read again
+            path = layer_source(layer).split('|')[0]
+            key = (layer_source(layer), os.path.getmtime(path) if os.path.exists(path) else None, VARS['admin_area'], crs.authid(), VARS['hilbert_order'])
+            with self.WINDOW_LOCK:
+                if key in self.WINDOW_CACHE:
+                    log(f"layer {name} windowed to the study area was taken from cache")
+                    return self.WINDOW_CACHE[key].materialize(QgsFeatureRequest())
+
+            #### read only the features in the study area bounding box, the provider uses its spatial index
+            mask = QgsGeometry.unaryUnion([f.geometry() for f in mask_layer.getFeatures()])
+            to_layer = QgsCoordinateTransform(crs, layer.crs(), QgsProject.instance())
+            to_mask = QgsCoordinateTransform(layer.crs(), crs, QgsProject.instance())
+            request = QgsFeatureRequest().setFilterRect(to_layer.transformBoundingBox(mask.boundingBox()))
+            engine = QgsGeometry.createGeometryEngine(mask.constGet())
+            engine.prepareGeometry()
+
+            wkb_type = QgsWkbTypes.multiType(layer.wkbType())
+            window = QgsVectorLayer(f"{QgsWkbTypes.displayString(wkb_type)}?crs={crs.authid()}", name, "memory")
+            window.dataProvider().addAttributes(layer.fields())
+            window.updateFields()
+
+            #### REPROJECT AND CLIP only the features of the window
+            features = []
+            for feature in layer.getFeatures(request):
+                if feedback.isCanceled():
+                    break
+                geometry = feature.geometry()
+                if layer.crs() != crs:
+                    geometry.transform(to_mask)
+                if not engine.intersects(geometry.constGet()):
+                    continue
+                if not engine.contains(geometry.constGet()):
+                    geometry = geometry.intersection(mask)
+                    geometry.convertGeometryCollectionToSubclass(QgsWkbTypes.geometryType(wkb_type))
+                geometry.convertToMultiType()
+                feature.setGeometry(geometry)
+                features.append(feature)
+            window.dataProvider().addFeatures(features)
+            log(f"layer {name} was read windowed to the study area in {crs.authid()}, features: {len(features)}")
+            if VARS['hilbert_order']:
+                window = hilbert_sort(name, window)
+
+            if not feedback.isCanceled():
+                with self.WINDOW_LOCK:
+                    self.WINDOW_CACHE[key] = window
+                    return window.materialize(QgsFeatureRequest())
+            return window
+
+        def hilbert_sort(name, layer):
+            #### spatially adjacent features are adjacent in memory, so the bbox queries and the per area loops touch fewer pages
+            result = hilbert_sorted(layer, name)
+            log(f"layer {name} was sorted along the Hilbert curve, features: {result.featureCount()}")
+            return result
+
+        def area_by_class(layer, field):
+            areas = {}
+            for f in layer.getFeatures():
+                key = f[field] if field else 'ALL'
+                areas[key] = areas.get(key, 0) + f.geometry().area()
+            return areas
+
+        def simplify(name, layer, tolerance, field=None):
+            #### topology-preserving simplification keeps shared boundaries consistent. Report the area error per class
+            if tolerance == 0:
+                return layer
+            before = area_by_class(layer, field)
+            if QgsApplication.processingRegistry().algorithmById('grass7:v.generalize') is not None:
+                params = {
+                    'input': layer,
+                    'type': [0, 1, 2],
+                    'method': 0,  #### douglas
+                    'threshold': tolerance,
+                    'output': 'TEMPORARY_OUTPUT',
+                    'error': 'TEMPORARY_OUTPUT'
+                }
+                with self.GRASS_LOCK:
+                    simplified = run_alg("grass7:v.generalize", params)['output']
+                if isinstance(simplified, str):
+                    simplified = QgsVectorLayer(simplified, name, "ogr")
+            else:
+                feedback.reportError(f"GRASS v.generalize is not available, layer {name} is simplified feature by feature and shared boundaries can move apart")
+                params = {
+                    'INPUT': layer,
+                    'METHOD': 0,  #### distance (Douglas-Peucker)
+                    'TOLERANCE': tolerance,
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                }
+                simplified = run_alg("native:simplifygeometries", params)['OUTPUT']
+            after = area_by_class(simplified, field)
+            log(f"layer {name} was simplified with tolerance {tolerance:g}, area error:")
+            for key, value in sorted(before.items(), key=lambda x: str(x[0])):
+                error = after.get(key, 0) - value
+                log(f"    {key}: {error:+.1f} ({(error / value * 100 if value else 0):+.3f}%)")
+            return simplified
+
+        def remove_slivers(name, layer):
+            #### merge the pieces smaller than the minimum area into their largest neighbour, drop the ones without neighbours
+            if VARS['min_piece_area'] == 0:
+                return layer
+            slivers = {}
+            for f in layer.getFeatures():
+                area = f.geometry().area()
+                if area < VARS['min_piece_area']:
+                    slivers[f.id()] = area
+            if not slivers:
+                log(f"{name}: no slivers found")
+                return layer
+            layer.selectByIds(list(slivers))
+            params = {
+                'INPUT': layer,
+                'MODE': 0,  #### largest area
+                'OUTPUT': 'TEMPORARY_OUTPUT'
+            }
+            layer = run_alg("qgis:eliminateselectedpolygons", params)['OUTPUT']
+            isolated = [f.id() for f in layer.getFeatures() if f.geometry().area() < VARS['min_piece_area']]
+            layer.dataProvider().deleteFeatures(isolated)
+            log(f"{name}: {len(slivers)} slivers with total area {sum(slivers.values()):.1f} were removed, {len(isolated)} of them had no neighbour and were dropped")
+            return layer
+
+        def snap_to_grid(name, layer):
+            #### snap the vertices to the fixed precision grid. Only the features broken by snapping are repaired,
+            #### so the whole layer checkvalidity/fixgeometries passes are not needed
+            layer, repaired, dropped = snap_layer_to_grid(layer, VARS['grid_size'], feedback)
+            log(f"layer {name} was snapped to {VARS['grid_size']:g} grid, {repaired} features repaired, {len(dropped)} collapsed and dropped")
+            return layer
+
+        def fixed_precision(params):
+            #### overlays run at the grid precision, their outputs are valid by construction (QGIS 3.28+)
+            if VARS['grid_size']:
+                params['GRID_SIZE'] = VARS['grid_size']
+            return params
+
+        def proximity_overlay(layer, water_layer, distance):
+            #### the pieces of the layer within the distance from each water body, as the intersection with its buffer.
+            #### the water bodies near a piece come from the index, the buffer is built only when the piece has to be clipped
+            index = QgsSpatialIndex(water_layer.getFeatures())
+            waters = {f.id(): f for f in water_layer.getFeatures()}
+            #### the buffers are keyed by a digest of the water geometry, computed once per water body
+            digests = {}
+            fields = QgsFields(layer.fields())
+            for field in water_layer.fields():
+                if field.name() not in layer.fields().names():
+                    fields.append(field)
+            wkb_type = QgsWkbTypes.multiType(layer.wkbType())
+            result = QgsVectorLayer(f"{QgsWkbTypes.displayString(wkb_type)}?crs={layer.crs().authid()}", "proximity", "memory")
+            result.dataProvider().addAttributes(fields)
+            result.updateFields()
+
+            features = []
+            kept = 0
+            clipped = 0
+            built = 0
+            for piece in layer.getFeatures():
+                if feedback.isCanceled():
+                    break
+                geometry = piece.geometry()
+                box = geometry.boundingBox()
+                #### every point of the piece is within the distance if its nearest point is close enough by the piece size
+                diameter = (box.width() ** 2 + box.height() ** 2) ** 0.5
+                box.grow(distance)
+                for fid in index.intersects(box):
+                    water = waters[fid]
+                    gap = geometry.distance(water.geometry())
+                    if gap > distance:
+                        continue
+                    if gap + diameter <= distance:
+                        part = QgsGeometry(geometry)
+                        kept += 1
+                    else:
+                        if fid not in digests:
+                            digests[fid] = hashlib.sha256(bytes(water.geometry().asWkb())).digest()
+                        key = (digests[fid], distance)
+                        with self.BUFFER_LOCK:
+                            buffer = self.BUFFER_CACHE.get(key)
+                            if buffer is not None:
+                                self.BUFFER_CACHE.move_to_end(key)
+                        if buffer is None:
+                            buffer = water.geometry().buffer(distance, 5)
+                            built += 1
+                            with self.BUFFER_LOCK:
+                                self.BUFFER_CACHE[key] = buffer
+                                while len(self.BUFFER_CACHE) > self.BUFFER_CACHE_SIZE:
+                                    self.BUFFER_CACHE.popitem(last=False)
+                        part = geometry.intersection(buffer)
+                        part.convertGeometryCollectionToSubclass(QgsWkbTypes.PolygonGeometry)
+                        if part.isEmpty():
+                            continue
+                        clipped += 1
+                    part.convertToMultiType()
+                    feature = QgsFeature(result.fields())
+                    feature.setGeometry(part)
+                    feature.setAttributes(piece.attributes() + [water[field.name()] for field in water_layer.fields() if field.name() not in layer.fields().names()])
+                    features.append(feature)
+            result.dataProvider().addFeatures(features)
+            log(f"pieces near water: {kept} kept whole, {clipped} clipped at {distance:g}, {built} water buffers built")
+            return result
+
+        def classify_areas(areas, pieces, veg_layer, margin):
+            #### the coarse areas are definitely suitable, definitely unsuitable or ambiguous for the targets. The coarse geometry is off
+            #### by about the margin, so the target area can be off by about the band of that width along the area boundary.
+            #### every suitable area holds target vegetation, so the target polygons of the exact input are returned as the seeds
+            #### of the exact pass, except the ones whose coarse areas nearby are all definitely unsuitable
+            names = {f.id(): f['MVS_NAME'] for f in pieces.getFeatures()}
+            pieces_index = QgsSpatialIndex(pieces.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+            areas_index = QgsSpatialIndex(areas.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+            codes = [str(code) for code, name in veg_codes.items() if name in dict(targets)]
+            request = QgsFeatureRequest().setFilterExpression(f"to_int(\"NVISDSC1\") IN ({', '.join(codes)})")
+            target_index = QgsSpatialIndex(veg_layer.getFeatures(request), flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+
+            classes = {}
+            for area in areas.getFeatures():
+                if feedback.isCanceled():
+                    break
+                geometry = area.geometry()
+                box = geometry.boundingBox()
+                box.grow(margin)
+                #### without target vegetation of the exact input within the margin the area can not become suitable
+                if not any(geometry.distance(target_index.geometry(fid)) <= margin for fid in target_index.intersects(box)):
+                    classes[area.id()] = 'unsuitable'
+                    continue
+                engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+                engine.prepareGeometry()
+                veg_sum = {}
+                for fid in pieces_index.intersects(geometry.boundingBox()):
+                    piece = pieces_index.geometry(fid)
+                    if engine.intersects(piece.pointOnSurface().constGet()):
+                        veg_sum[names[fid]] = veg_sum.get(names[fid], 0) + piece.area()
+                total = sum(veg_sum.values())
+                band = geometry.length() * margin
+                states = set()
+                for target, min_share in targets:
+                    share = veg_sum.get(target, 0)
+                    lower = max(share - band, 0) / (total + band)
+                    upper = (share + band) / (total - band) if total > band else 1
+                    if share > band and lower >= min_share:
+                        states.add('suitable')
+                    elif upper < min_share:
+                        states.add('unsuitable')
+                    else:
+                        states.add('ambiguous')
+                classes[area.id()] = 'suitable' if 'suitable' in states else 'ambiguous' if 'ambiguous' in states else 'unsuitable'
+
+            #### a target polygon far from every coarse area may be in an exact area the simplification has lost, it is kept
+            seeds = []
+            total = 0
+            for fid in target_index.intersects(veg_layer.extent()):
+                total += 1
+                target = target_index.geometry(fid)
+                box = target.boundingBox()
+                box.grow(margin)
+                near = [other for other in areas_index.intersects(box) if target.distance(areas_index.geometry(other)) <= margin]
+                if not near or any(classes.get(other) != 'unsuitable' for other in near):
+                    seeds.append(target)
+
+            counts = {state: list(classes.values()).count(state) for state in ['suitable', 'unsuitable', 'ambiguous']}
+            log(f"coarse areas: {counts['suitable']} definitely suitable, {counts['unsuitable']} definitely unsuitable, {counts['ambiguous']} ambiguous")
+            log(f"target vegetation polygons to refine: {len(seeds)} of {total}")
+            return seeds
+
+        def check_areas(areas, pieces, core, seeds, seeds_index):
+            #### inside the core the inputs of the exact pass are complete, so an area equals the one of the exact path when it and
+            #### all its pieces are inside the core clear of its boundary. The incomplete areas holding seeds are returned
+            #### as the extents to grow the core by, the other incomplete areas are returned to be left out
+            grow = []
+            dropped = []
+            if core.isEmpty():
+                return grow, [area.id() for area in areas.getFeatures()]
+            core_engine = QgsGeometry.createGeometryEngine(core.constGet())
+            core_engine.prepareGeometry()
+            boundary = QgsGeometry(core.constGet().boundary())
+            boundary_engine = QgsGeometry.createGeometryEngine(boundary.constGet())
+            boundary_engine.prepareGeometry()
+            def inside(geometry):
+                return core_engine.contains(geometry.constGet()) and not boundary_engine.intersects(geometry.constGet())
+
+            pieces_index = QgsSpatialIndex(pieces.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+            for area in areas.getFeatures():
+                if feedback.isCanceled():
+                    break
+                geometry = area.geometry()
+                engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+                engine.prepareGeometry()
+                parts = [pieces_index.geometry(fid) for fid in pieces_index.intersects(geometry.boundingBox())]
+                parts = [part for part in parts if engine.intersects(part.constGet())]
+                if inside(geometry) and all(inside(part) for part in parts):
+                    continue
+                if any(engine.intersects(seeds[i].constGet()) for i in seeds_index.intersects(geometry.boundingBox())):
+                    #### the exact area reaches out by an unknown length, the extent is at least doubled each time
+                    box = QgsRectangle(geometry.boundingBox())
+                    for part in parts:
+                        box.combineExtentWith(part.boundingBox())
+                    box.grow(max((box.width() ** 2 + box.height() ** 2) ** 0.5, 1))
+                    grow.append(box)
+                else:
+                    dropped.append(area.id())
+            return grow, dropped
+
+        def mask_layer(name, geometries, distance):
+            #### the geometries grown by the distance as a memory layer for the extractions
+            layer = QgsVectorLayer(f"MultiPolygon?crs={LAYERS['admin'].crs().authid()}", name, "memory")
+            features = []
+            for geometry in geometries:
+                buffer = geometry.buffer(distance, 5)
+                buffer.convertToMultiType()
+                feature = QgsFeature()
+                feature.setGeometry(buffer)
+                features.append(feature)
+            layer.dataProvider().addFeatures(features)
+            return layer
+
+        def raster_composition(raster_path, areas, field):
+            #### vegetation composition of all areas from the gridded NVIS in one sweep: the area numbers of the field are rasterized
+            #### on the raster grid and the (area number, NVIS_ID) pixel pairs are counted in one vectorized pass.
+            #### the areas without any pixel centre get no statistics
+            raster = gdal.Open(raster_path)
+            if raster is None:
+                raise QgsProcessingException(f"Vegetation raster {raster_path} failed to load")
+            band = raster.GetRasterBand(1)
+            gt = raster.GetGeoTransform()
+
+            #### the areas in the raster CRS, only the raster window covering them is read
+            areas_path = QgsProcessingUtils.generateTempFilename('areas.gpkg')
+            params = {
+                'INPUT': areas,
+                'TARGET_CRS': QgsCoordinateReferenceSystem.fromWkt(raster.GetProjection()),
+                'OUTPUT': areas_path
+            }
+            run_alg('native:reprojectlayer', params)
+            extent = QgsVectorLayer(areas_path, "areas", "ogr").extent()
+            xoff = max(0, int(np.floor((extent.xMinimum() - gt[0]) / gt[1])))
+            yoff = max(0, int(np.floor((extent.yMaximum() - gt[3]) / gt[5])))
+            xend = min(raster.RasterXSize, int(np.ceil((extent.xMaximum() - gt[0]) / gt[1])))
+            yend = min(raster.RasterYSize, int(np.ceil((extent.yMinimum() - gt[3]) / gt[5])))
+            if xend <= xoff or yend <= yoff:
+                return {}
+            codes = band.ReadAsArray(xoff, yoff, xend - xoff, yend - yoff).astype(np.int64)
+
+            grid = gdal.GetDriverByName('MEM').Create('', xend - xoff, yend - yoff, 1, gdal.GDT_Int32)
+            grid.SetGeoTransform((gt[0] + xoff * gt[1], gt[1], 0, gt[3] + yoff * gt[5], 0, gt[5]))
+            grid.SetProjection(raster.GetProjection())
+            gdal.Rasterize(grid, areas_path, attribute=field)
+            ids = grid.ReadAsArray().astype(np.int64)
+
+            #### the pixel area in m2 per row, the pixels of a geographic raster shrink away from the equator
+            crs = QgsCoordinateReferenceSystem.fromWkt(raster.GetProjection())
+            distance_area = QgsDistanceArea()
+            distance_area.setSourceCrs(crs, QgsProject.instance().transformContext())
+            distance_area.setEllipsoid(crs.ellipsoidAcronym() or 'EPSG:7019')
+            x0 = gt[0] + xoff * gt[1]
+            row_area = np.empty(yend - yoff)
+            for row in range(yend - yoff):
+                y = gt[3] + (yoff + row) * gt[5]
+                pixel = QgsGeometry.fromRect(QgsRectangle(x0, y, x0 + gt[1], y + gt[5]))
+                row_area[row] = distance_area.convertAreaMeasurement(distance_area.measureArea(pixel), QgsUnitTypes.AreaSquareMeters)
+            pixel_area = np.broadcast_to(row_area[:, None], ids.shape)
+
+            #### count the pairs
+            valid = (ids > 0) & (codes >= 0)
+            if band.GetNoDataValue() is not None:
+                valid &= codes != band.GetNoDataValue()
+            if not valid.any():
+                return {}
+            base = int(codes[valid].max()) + 1
+            keys, inverse = np.unique(ids[valid] * base + codes[valid], return_inverse=True)
+            df = pd.DataFrame({
+                'area': keys // base,
+                'NVIS_ID': keys % base,
+                'Shape_Area': np.bincount(inverse, weights=pixel_area[valid])
+            })
+            df['MVS_NAME'] = df['NVIS_ID'].map(veg_codes)
+            df = df.groupby(['area', 'MVS_NAME']).agg({'Shape_Area': 'sum'})
+            df['veg_perc'] = df['Shape_Area'] / df.groupby(level='area')['Shape_Area'].transform('sum')
+            return {int(area): group.droplevel('area') for area, group in df.groupby(level='area')}
+
         def add_shape_area(layer, field_names={'area': 'Shape_Area', 'length': 'Shape_Leng'}):
 
             geom = layer.geometryType()
@@ -347,6 +1221,8 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
             context = QgsExpressionContext()
             context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
             for f in layer.getFeatures():
+                if feedback.isCanceled():
+                    break
                 context.setFeature(f)
                 f[area] = expression_a.evaluate(context)
                 f[length] = expression_l.evaluate(context)
@@ -383,9 +1259,10 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
         else:
             log(f"'NVIS6_0_LUT_AUST_FLAT.csv' vegetation code-name table was located. OK.")
 
-        #### create a dictionary of the layers
-        LAYERS = {}
-        for name, value in LAYERS_PARAMS.items():
+        #### create a dictionary of the layers. The processing context is not thread safe,
+        #### so the inputs are loaded and validated on the algorithm thread
+        def load_input(name):
+            value = LAYERS_PARAMS[name]
             layer = self.parameterAsVectorLayer(
                 parameters,
                 value['input'],
@@ -402,8 +1279,9 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
                 raise QgsProcessingException(f"Looks like you have selected wrong layer for {value['label']}.")
             else:
                 log(f"Layer {value['label']} loaded and of correct type. OK.")
+            return layer
 
-            LAYERS[name] = layer
+        LAYERS = {name: load_input(name) for name in LAYERS_PARAMS}
 
         #### apply style to the layers
         for name, layer in LAYERS.items():
@@ -432,11 +1310,25 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
                     )
                 except:
                     raise QgsProcessingException(f"Wrong variable type {value['description']}, it must be Number")
+            elif value['parameter'].typeName() == "boolean":  #### QgsProcessingParameterBoolean
+                try:
+                    VARS[name] = self.parameterAsBool(
+                        parameters,
+                        value["input"], #### string "INPUT_...",
+                        context
+                    )
+                except:
+                    raise QgsProcessingException(f"Wrong variable type {value['description']}, it must be Boolean")
 
         #### USER FEEDBACK ON ERRORS
-        for var in ["admin_area", "veg_name"]:
+        for var in ["admin_area"]:
+            if var == "admin_area" and VARS["windowed_inputs"]:
+                continue
             if VARS[var] != VAR_PARAMS[var]['default']:
                 raise QgsProcessingException(f"This is a test algorythm working only for '{VAR_PARAMS[var]['default']}' as {VAR_PARAMS[var]['description']}. Please correct and try again.")    
+        #### without the grid in the overlays their outputs are not valid by construction, and no fixing is done
+        if VARS['grid_size'] and Qgis.QGIS_VERSION_INT < GRID_SIZE_MIN_VERSION:
+            raise QgsProcessingException(f"{VAR_PARAMS['grid_size']['description']} requires QGIS 3.28 or later, QGIS {Qgis.QGIS_VERSION} ignores the grid in the overlays. Please set it to 0.")
 
         #### create dictionary for outputs
         OUTPUT = {}
@@ -471,7 +1363,26 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
             ],
             'OUTPUT':'TEMPORARY_OUTPUT'
         }
-        veg_table = processing.run("native:refactorfields", params)['OUTPUT']
+        veg_table = run_alg("native:refactorfields", params)['OUTPUT']
+
+        #### TARGET VEGETATION TYPES with their minimum share, all of them are evaluated in one site selection pass
+        veg_codes = {f['NVIS_ID']: f['MVS_NAME'] for f in veg_table.getFeatures()}
+        veg_names = set(veg_codes.values())
+        targets = []
+        for item in VARS['veg_name'].split(';'):
+            if not item.strip():
+                continue
+            target, _, min_share = item.partition(':')
+            try:
+                min_share = float(min_share) if min_share.strip() else 0.0
+            except ValueError:
+                raise QgsProcessingException(f"Wrong minimum share '{min_share}' for {target.strip()} in {VAR_PARAMS['veg_name']['description']}")
+            if target.strip() not in veg_names:
+                raise QgsProcessingException(f"'{target.strip()}' is not a vegetation type of 'NVIS6_0_LUT_AUST_FLAT.csv'. Please correct and try again.")
+            targets.append((target.strip(), min_share))
+        if not targets:
+            raise QgsProcessingException(f"At least one {VAR_PARAMS['veg_name']['description']} is required")
+        log(f"Target vegetation types: {', '.join(f'{x} (min share {y:g})' for x, y in targets)}")
 
         #### SELECT ADMIN AREA FROM VICTORIA (this step is done already to save on data upload)
         params = {
@@ -481,167 +1392,320 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
             'VALUE': VARS["admin_area"],
             'OUTPUT': 'TEMPORARY_OUTPUT'
         }
-        LAYERS['admin'] = processing.run("native:extractbyattribute", params)['OUTPUT']
+        LAYERS['admin'] = run_alg("native:extractbyattribute", params)['OUTPUT']
+        #### an unknown region gives an empty study area, the windowed reading would then keep no features and find no sites
+        if LAYERS['admin'].featureCount() == 0:
+            raise QgsProcessingException(f"No '{VARS['admin_area']}' area was found in {LAYERS_PARAMS['admin']['label']}, please correct the {VAR_PARAMS['admin_area']['description']} and try again.")
         log('-'*30)
         log(f"{VARS['admin_area']} area from {LAYERS_PARAMS['admin']['label']} was selected")
 
-        #### REPROJECT AND CLIP ALL LAYERS BY THE STUDY AREA, IF VEGETATION, ADD VEGETATION NAMES
-        for name, layer in LAYERS.items():
-            if name != 'admin':
-                ##### this commented out step reprojects and clips each layer by admin polygon
-                # layer = load_reproject_and_clip(name, layer, LAYERS['admin'])
-                if name == 'veg':
-                    ##### join vegetation layers to code
+        #### SIMPLIFICATION TOLERANCE, tied to the smallest buffer of the analysis
+        buffers = [abs(x) for x in [VARS['facilities_buffer'], VARS['water_buffer']] if x != 0]
+        tolerance = VARS['simplify_factor'] * min(buffers) if buffers else 0
+
+        def build_pieces(LAYERS, tolerance, use_cache, masks=None):
+            #### the overlay chain on a copy of the inputs, it returns the pieces of the suitable areas.
+            #### masks restrict the inputs to the features intersecting them, per layer name
+            LAYERS = dict(LAYERS)
+            #### ZONES x VEGETATION BASE OVERLAY
+            #### it does not depend on the hydro variables, so it is materialized once per region and facilities buffer
+            #### and water scenarios only intersect their buffers against it.
+            zones_expr = '\"ZONE_DESC\"  LIKE \'%WEDGE%\' OR \"ZONE_DESC\"  LIKE \'%FARMING%\' OR \"ZONE_DESC\"  LIKE \'%CONSERVATION%\' OR \"ZONE_DESC\"  LIKE \'%RECREATION%\' OR \"ZONE_DESC\"  LIKE \'%PUBLIC USE ZONE%\' '
+            #### the key also hashes the zones, vegetation and lookup table sources with their modification times,
+            #### the zones selection and the windowed mode, so a changed input never reuses a stale overlay
+            def source_key(source):
+                path = source.split('|')[0]
+                return f"{source}@{os.path.getmtime(path) if os.path.exists(path) else ''}"
+            sources = [source_key(layer_source(LAYERS['zones'])), source_key(layer_source(LAYERS['veg'])), source_key(self.veg_table_path), zones_expr, str(VARS['windowed_inputs']), str(VARS['hilbert_order'])]
+            base_path = f"{self.cache_path}/base_overlay_{VARS['admin_area'].replace(' ', '_')}_{VARS['facilities_buffer']:g}"
+            base_path += f"_s{tolerance:g}" if tolerance else ""
+            base_path += f"_m{VARS['min_piece_area']:g}" if VARS['min_piece_area'] else ""
+            base_path += f"_g{VARS['grid_size']:g}" if VARS['grid_size'] else ""
+            base_path += f"_{hashlib.md5('|'.join(sources).encode('utf-8')).hexdigest()[:12]}.gpkg"
+            base_layer = None
+            if use_cache:
+                base_layer = QgsVectorLayer(base_path, "base_overlay", "ogr")
+                if base_layer.isValid():
+                    log(f"Materialized {LAYERS_PARAMS['zones']['label']} x {LAYERS_PARAMS['veg']['label']} overlay loaded from {base_path}")
+                else:
+                    base_layer = None
+
+            #### REPROJECT AND CLIP ALL LAYERS BY THE STUDY AREA
+            ##### this commented out step reprojects and clips each layer by admin polygon
+            # for name, layer in LAYERS.items():
+            #     if name != 'admin':
+            #         LAYERS[name] = load_reproject_and_clip(name, layer, LAYERS['admin'])
+            #### statewide layers are read windowed to the study area instead, only the ones still needed
+            names = ['hydro'] if base_layer is not None else ['hydro', 'zones', 'veg']
+            if VARS['windowed_inputs']:
+                stages = {name: (lambda name=name: load_windowed(name, LAYERS[name], LAYERS['admin'])) for name in names}
+                LAYERS.update(run_stages(stages, int(VARS['workers'])))
+
+            #### FIXED PRECISION
+            if VARS['grid_size']:
+                stages = {name: (lambda name=name: snap_to_grid(name, LAYERS[name])) for name in names}
+                LAYERS.update(run_stages(stages, int(VARS['workers'])))
+
+            #### only the features intersecting the masks are kept whole, so the overlays inside the masks are exact
+            if masks:
+                for name, mask in masks.items():
                     params = {
-                        'INPUT': layer,
-                        'FIELD': 'NVISDSC1',
-                        'INPUT_2': veg_table,
-                        'FIELD_2':'NVIS_ID',
-                        'FIELDS_TO_COPY': ['MVS_NAME'],
-                        'METHOD': 0,
-                        'DISCARD_NONMATCHING': True,
-                        'PREFIX': '',
-                        'OUTPUT':'TEMPORARY_OUTPUT'
+                        'INPUT': LAYERS[name],
+                        'PREDICATE': [0],  #### intersect
+                        'INTERSECT': mask,
+                        'OUTPUT': 'TEMPORARY_OUTPUT'
                     }
-                    layer = processing.run("native:joinattributestable", params)['OUTPUT']
-                LAYERS[name] = layer
+                    features = LAYERS[name].featureCount()
+                    LAYERS[name] = run_alg("native:extractbylocation", params)['OUTPUT']
+                    log(f"layer {LAYERS_PARAMS[name]['label']} was restricted to the refined extents, features: {LAYERS[name].featureCount()} of {features}")
 
-        ###############################################
-        ##### SITE LOCATION
+            ###############################################
+            ##### SITE LOCATION
+            #### the branches below are independent and run concurrently
 
-        #### PLANNING ZONES
-        #### select by type
-        expr = '\"ZONE_DESC\"  LIKE \'%WEDGE%\' OR \"ZONE_DESC\"  LIKE \'%FARMING%\' OR \"ZONE_DESC\"  LIKE \'%CONSERVATION%\' OR \"ZONE_DESC\"  LIKE \'%RECREATION%\' OR \"ZONE_DESC\"  LIKE \'%PUBLIC USE ZONE%\' '
-        params = {
-            'INPUT':LAYERS['zones'],
-            'EXPRESSION':expr,
-            'OUTPUT':'TEMPORARY_OUTPUT'
-        }
-        layer = processing.run("native:extractbyexpression", params)['OUTPUT']
-
-        #### dissolve
-        params = {
-            'INPUT':layer,
-            'FIELD':[],
-            'OUTPUT':'TEMPORARY_OUTPUT'
-        }
-        layer = processing.run("native:dissolve", params)['OUTPUT']
+            #### VEGETATION
+            def veg_stage():
+                ##### join vegetation layers to code
+                params = {
+                    'INPUT': LAYERS['veg'],
+                    'FIELD': 'NVISDSC1',
+                    'INPUT_2': veg_table,
+                    'FIELD_2':'NVIS_ID',
+                    'FIELDS_TO_COPY': ['MVS_NAME'],
+                    'METHOD': 0,
+                    'DISCARD_NONMATCHING': True,
+                    'PREFIX': '',
+                    'OUTPUT':'TEMPORARY_OUTPUT'
+                }
+                layer = run_alg("native:joinattributestable", params)['OUTPUT']
+                log(f"Vegetation names were added to layer {LAYERS_PARAMS['veg']['label']}")
+                return simplify(LAYERS_PARAMS['veg']['label'], layer, tolerance, 'MVS_NAME')
+
+            #### PLANNING ZONES
+            def zones_stage():
+                #### select by type
+                expr = zones_expr
+                params = {
+                    'INPUT':LAYERS['zones'],
+                    'EXPRESSION':expr,
+                    'OUTPUT':'TEMPORARY_OUTPUT'
+                }
+                layer = run_alg("native:extractbyexpression", params)['OUTPUT']
+                #### only the selected zones are simplified
+                layer = simplify(LAYERS_PARAMS['zones']['label'], layer, tolerance)
 
-        #### buffer the zones inside
-        params = {
-            'INPUT': layer, 
-            'DISTANCE': VARS['facilities_buffer'],
-            'SEGMENTS': 5,
-            'END_CAP_STYLE': 0,
-            'JOIN_STYLE': 0,
-            'MITER_LIMIT': 2,
-            'DISSOLVE': False,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        layer = processing.run("native:buffer", params)['OUTPUT']
+                #### dissolve
+                params = {
+                    'INPUT':layer,
+                    'FIELD':[],
+                    'OUTPUT':'TEMPORARY_OUTPUT'
+                }
+                layer = run_alg("native:dissolve", fixed_precision(params))['OUTPUT']
 
-        LAYERS['zones'] = layer
+                #### buffer the zones inside
+                params = {
+                    'INPUT': layer, 
+                    'DISTANCE': VARS['facilities_buffer'],
+                    'SEGMENTS': 5,
+                    'END_CAP_STYLE': 0,
+                    'JOIN_STYLE': 0,
+                    'MITER_LIMIT': 2,
+                    'DISSOLVE': False,
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                }
+                layer = run_alg("native:buffer", params)['OUTPUT']
 
-        log(f"Suitable areas from layer {LAYERS_PARAMS['zones']['label']} were selected")
+                log(f"Suitable areas from layer {LAYERS_PARAMS['zones']['label']} were selected")
+                return layer
 
-        #### HYDROLOGY
-        #### select hydrology by watertype
-        expr = '\"FTYPE_CODE\" LIKE \'%watercourse_area_river%\' OR \"FTYPE_CODE\" LIKE \'%wb_lake%\' '
-        params = {
-            'INPUT': LAYERS['hydro'],
-            'EXPRESSION':expr,
-            'OUTPUT':'TEMPORARY_OUTPUT'
-        }
-        layer = processing.run("native:extractbyexpression", params)['OUTPUT']
+            #### HYDROLOGY
+            def hydro_stage():
+                #### select hydrology by watertype
+                expr = '\"FTYPE_CODE\" LIKE \'%watercourse_area_river%\' OR \"FTYPE_CODE\" LIKE \'%wb_lake%\' '
+                params = {
+                    'INPUT': LAYERS['hydro'],
+                    'EXPRESSION':expr,
+                    'OUTPUT':'TEMPORARY_OUTPUT'
+                }
+                layer = run_alg("native:extractbyexpression", params)['OUTPUT']
 
-        #### select hydrology by size
-        #### add shape area
-        layer = add_shape_area(layer)
-        params = {
-            'INPUT': layer,
-            'FIELD': 'Shape_Area',
-            'OPERATOR': 3,  # >=
-            'VALUE': VARS['min_water_area'],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        layer = processing.run("native:extractbyattribute", params)['OUTPUT']
+                #### select hydrology by size
+                #### add shape area
+                layer = add_shape_area(layer)
+                params = {
+                    'INPUT': layer,
+                    'FIELD': 'Shape_Area',
+                    'OPERATOR': 3,  # >=
+                    'VALUE': VARS['min_water_area'],
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                }
+                layer = run_alg("native:extractbyattribute", params)['OUTPUT']
+                #### simplified after the size filter, so the selection of the water bodies does not depend on the tolerance
+                layer = simplify(LAYERS_PARAMS['hydro']['label'], layer, tolerance)
+                if VARS['water_index']:
+                    log(f"Suitable areas from layer {LAYERS_PARAMS['hydro']['label']} were selected, distance is checked through the index")
+                    return layer
+
+                #### buffer hydro layer
+                params = {
+                    'INPUT': layer, 
+                    'DISTANCE': VARS['water_buffer'],
+                    'SEGMENTS': 5,
+                    'END_CAP_STYLE': 0,
+                    'JOIN_STYLE': 0,
+                    'MITER_LIMIT': 2,
+                    'DISSOLVE': False,
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                }
+                layer = run_alg("native:buffer", params)['OUTPUT']
+
+                log(f"Suitable areas from layer {LAYERS_PARAMS['hydro']['label']} were selected")
+                return layer
+
+            stages = {'hydro': hydro_stage}
+            if base_layer is None:
+                stages['zones'] = zones_stage
+                stages['veg'] = veg_stage
+            LAYERS.update(run_stages(stages, int(VARS['workers'])))
+
+            if base_layer is None:
+                #### INTERSECT VEGETATION WITH ZONES
+                log(" ")
+                log(f"*****  Intersection of the layers can take several minutes due to large amount of data. *****")
+                log(" ")
+                params = {
+                    'INPUT': LAYERS['veg'],
+                    'OVERLAY': LAYERS['zones'],
+                    'INPUT_FIELDS':[],
+                    'OVERLAY_FIELDS':[],
+                    'OVERLAY_FIELDS_PREFIX':'',
+                    'OUTPUT':'TEMPORARY_OUTPUT'
+                }
+                base_layer = run_alg("native:intersection", fixed_precision(params))['OUTPUT']
+                base_layer = remove_slivers(f"{LAYERS_PARAMS['veg']['label']} x {LAYERS_PARAMS['zones']['label']}", base_layer)
+                if VARS['hilbert_order']:
+                    base_layer = hilbert_sort("base_overlay", base_layer)
+                run_alg("native:createspatialindex", {'INPUT': base_layer})
+                log(f"veg and zones intersected")
+
+                if use_cache:
+                    if not os.path.exists(f"{self.cache_path}"):
+                        os.makedirs(f"{self.cache_path}")
+                    #### written to a temporary file and moved in place, so an interrupted or concurrent run never leaves a truncated overlay
+                    temp_path = f"{self.cache_path}/{uuid.uuid4().hex}.tmp.gpkg"
+                    error = QgsVectorFileWriter.writeAsVectorFormat(base_layer, temp_path, 'utf-8', driverName='GPKG')
+                    if error[0] == QgsVectorFileWriter.NoError:
+                        os.replace(temp_path, base_path)
+                        log(f"{LAYERS_PARAMS['zones']['label']} x {LAYERS_PARAMS['veg']['label']} overlay saved to {base_path}")
+                    else:
+                        if os.path.exists(temp_path):
+                            os.remove(temp_path)
+                        feedback.reportError(f"{LAYERS_PARAMS['zones']['label']} x {LAYERS_PARAMS['veg']['label']} overlay was not saved: {error[1]}")
+
+            ##### FIND INTERSECTION OF LAYERS
+            #### INTERSECT BASE OVERLAY WITH HYDRO BUFFER
+            if VARS['water_index']:
+                layer = proximity_overlay(base_layer, LAYERS['hydro'], VARS['water_buffer'])
+            else:
+                params = {
+                    'INPUT': base_layer,
+                    'OVERLAY': LAYERS['hydro'],
+                    'INPUT_FIELDS':[],
+                    'OVERLAY_FIELDS':[],
+                    'OVERLAY_FIELDS_PREFIX':'',
+                    'OUTPUT':'TEMPORARY_OUTPUT'
+                }
+                layer = run_alg("native:intersection", fixed_precision(params))['OUTPUT']
+            layer = remove_slivers(f"{LAYERS_PARAMS['veg']['label']} x {LAYERS_PARAMS['zones']['label']} x {LAYERS_PARAMS['hydro']['label']}", layer)
+            log(f"veg, zones and hydro were intersected")
+            #### remove unnecessary fields
 
-        #### buffer hydro layer
-        params = {
-            'INPUT': layer, 
-            'DISTANCE': VARS['water_buffer'],
-            'SEGMENTS': 5,
-            'END_CAP_STYLE': 0,
-            'JOIN_STYLE': 0,
-            'MITER_LIMIT': 2,
-            'DISSOLVE': False,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        layer = processing.run("native:buffer", params)['OUTPUT']
+            fieldNames = ['OBJECTID', 'NVISDSC1', 'Shape_Leng', 'Shape_Area', 'NAME', 'FTYPE_CODE', 'LGA', 'ZONE_DESC', 'MVS_NAME']
+            selected_layer_pieces = reduce_attributes(layer, fieldNames)
 
-        LAYERS['hydro'] = layer
-        log(f"Suitable areas from layer {LAYERS_PARAMS['hydro']['label']} were selected")
+            log(f"All layers were intersected")
+            log(" ")
+            return selected_layer_pieces
 
-        ##### FIND INTERSECTION OF LAYERS
-        #### INTERSECT HYDRO BUFFER WITH ZONES
-        log(" ")
-        log(f"*****  Intersection of the layers can take several minutes due to large amount of data. *****")
-        log(" ")
-        params = {
-            'INPUT': LAYERS['hydro'],
-            'OVERLAY': LAYERS['zones'],
-            'INPUT_FIELDS':[],
-            'OVERLAY_FIELDS':[],
-            'OVERLAY_FIELDS_PREFIX':'',
-            'OUTPUT':'TEMPORARY_OUTPUT'
-        }
-        layer = processing.run("native:intersection", params)['OUTPUT']
-        log(f"hydro and zones intersected")
-        #### INTERSECT HYDRO BUFFER WITH VEGETATION
-        params = {
-            'INPUT': LAYERS['veg'],
-            'OVERLAY': layer,
-            'INPUT_FIELDS':[],
-            'OVERLAY_FIELDS':[],
-            'OVERLAY_FIELDS_PREFIX':'',
-            'OUTPUT':'TEMPORARY_OUTPUT'
-        }
-        layer = processing.run("native:intersection", params)['OUTPUT']
-        log(f"veg and others were intersected")
-        #### remove unnecessary fields
+        def build_areas(selected_layer_pieces):
+            ##### CREATE DISSOLVED POLYGONS FOR EACH REGION
+            #### disolve all
+            params = {
+                'INPUT': selected_layer_pieces,
+                'FIELD':[],
+                'OUTPUT':'TEMPORARY_OUTPUT'
+                }
+            selected_layer_areas = run_alg("native:dissolve", fixed_precision(params))['OUTPUT']
+            #### separate to multiparts
+            params =  {
+                'INPUT': selected_layer_areas,
+                'OUTPUT':'TEMPORARY_OUTPUT'
+            }
+            selected_layer_areas = run_alg("native:multiparttosingleparts", params)['OUTPUT']
 
-        fieldNames = ['OBJECTID', 'NVISDSC1', 'Shape_Leng', 'Shape_Area', 'NAME', 'FTYPE_CODE', 'LGA', 'ZONE_DESC', 'MVS_NAME']
-        selected_layer_pieces = reduce_attributes(layer, fieldNames)
+            #### remove unnecessary fields
+            fieldNames = ['OBJECTID', 'Shape_Leng', 'Shape_Area']
+            selected_layer_areas = reduce_attributes(selected_layer_areas, fieldNames)
+       
+            #### recalculate Area and perimeter
+            selected_layer_pieces = add_shape_area(selected_layer_pieces)
+            selected_layer_areas = add_shape_area(selected_layer_areas)
+            return selected_layer_pieces, selected_layer_areas
+
+        #### COARSE TO FINE
+        #### the coarse pass runs on heavily simplified inputs. Its areas without any target vegetation near them are out for sure,
+        #### the exact pass runs only around the target vegetation of the rest and leaves out the areas it can not complete
+        coarse_tolerance = VARS['coarse_factor'] * min(buffers) if buffers else 0
+        coarse = coarse_tolerance > tolerance
+        if coarse:
+            log(" ")
+            log(f"***** Coarse pass with simplification tolerance {coarse_tolerance:g} *****")
+            log(" ")
+            coarse_pieces, coarse_areas = build_areas(build_pieces(LAYERS, coarse_tolerance, VARS['cache_base_overlay']))
+            #### the boundaries of both passes move by about their tolerance, the margin takes twice of it
+            margin = 2 * (coarse_tolerance + tolerance)
+            veg_layer = load_windowed('veg', LAYERS['veg'], LAYERS['admin']) if VARS['windowed_inputs'] else LAYERS['veg']
+            seeds = classify_areas(coarse_areas, coarse_pieces, veg_layer, margin)
+            seeds_index = QgsSpatialIndex()
+            for i, seed in enumerate(seeds):
+                seeds_index.addFeature(i, seed.boundingBox())
+
+            #### the exact pass reads every feature intersecting the core, the zones and the water within their buffers around it,
+            #### so inside the core its overlays equal the exact path. The core grows until no area holding seeds reaches out of it
+            core = QgsGeometry.unaryUnion([seed.buffer(margin, 5) for seed in seeds])
+            refine = 1
+            while True:
+                log(" ")
+                log(f"***** Exact pass {refine} on the refined extents *****")
+                log(" ")
+                masks = {
+                    'veg': mask_layer('veg_mask', [core], 0),
+                    'zones': mask_layer('zones_mask', [core], abs(VARS['facilities_buffer']) + margin),
+                    'hydro': mask_layer('hydro_mask', [core], VARS['water_buffer'] + margin)
+                }
+                #### the inputs are restricted, so the exact base overlay is neither read from nor saved to the cache
+                selected_layer_pieces, selected_layer_areas = build_areas(build_pieces(LAYERS, tolerance, False, masks))
+                grow, dropped = check_areas(selected_layer_areas, selected_layer_pieces, core, seeds, seeds_index)
+                if not grow:
+                    break
+                log(f"{len(grow)} areas with target vegetation reach out of the refined extents, the extents are grown")
+                core = QgsGeometry.unaryUnion([core] + [QgsGeometry.fromRect(box) for box in grow])
+                refine += 1
+            #### the areas without seeds can not be suitable, the incomplete ones are left out instead of evaluated on partial inputs
+            selected_layer_areas.dataProvider().deleteFeatures(dropped)
+            log(f"{len(dropped)} areas without target vegetation reach out of the refined extents and were left out")
+        else:
+            selected_layer_pieces, selected_layer_areas = build_areas(build_pieces(LAYERS, tolerance, VARS['cache_base_overlay']))
 
-        log(f"All layers were intersected")
-        log(" ")
         ###############################################
         ##### SITE SELECTION        
         log(" ")
         log(f"***** Selection sites by vegetation type can take several minutes due to large amount of data. *****")
         log(" ")
-        ##### CREATE DISSOLVED POLYGONS FOR EACH REGION
-        #### disolve all
-        params = {
-            'INPUT': selected_layer_pieces,
-            'FIELD':[],
-            'OUTPUT':'TEMPORARY_OUTPUT'
-            }
-        selected_layer_areas = processing.run("native:dissolve", params)['OUTPUT']
-        #### separate to multiparts
-        params =  {
-            'INPUT': selected_layer_areas,
-            'OUTPUT':'TEMPORARY_OUTPUT'
-        }
-        selected_layer_areas = processing.run("native:multiparttosingleparts", params)['OUTPUT']
-
-        #### remove unnecessary fields
-        fieldNames = ['OBJECTID', 'Shape_Leng', 'Shape_Area']
-        selected_layer_areas = reduce_attributes(selected_layer_areas, fieldNames)
-       
-        #### recalculate Area and perimeter
-        selected_layer_pieces = add_shape_area(selected_layer_pieces)
-        selected_layer_areas = add_shape_area(selected_layer_areas)
+        #### the pieces are packed and the areas are numbered and sharded in the curve order
+        if VARS['hilbert_order']:
+            selected_layer_pieces = hilbert_sort("pieces", selected_layer_pieces)
+            selected_layer_areas = hilbert_sort("areas", selected_layer_areas)
 
 
         ################################
@@ -650,83 +1714,203 @@ class SuitabilityAnalysis(QgsProcessingAlgorithm):
         n = selected_layer_areas.featureCount()
         log(f"areas: {n}, small piecses: {selected_layer_pieces.featureCount()}")
 
-        fields = [x for x in selected_layer_pieces.dataProvider().fields()]  
-        total = 100.0 / n if n != 0 else 0
-        area_ids = []
         total = 100.0 / n if n != 0 else 0
-        current = 0
 
+        csv_path = VARS['csv_folder'] or self.csv_path
         # Check whether the specified path exists or not
-        if not os.path.exists(f"{self.csv_path}"):
+        if not os.path.exists(f"{csv_path}"):
             # Create a new directory because it does not exist 
-            os.makedirs(f"{self.csv_path}")
+            os.makedirs(f"{csv_path}")
             log("The new directory csv is created!")
-        selected_layer_areas.startEditing()
-        for area in selected_layer_areas.getFeatures():
-            #### set the feature ID to consequent integers
-            # area['OBJECTID'] = current + 1
-            # selected_layer_areas.updateFeature(area)
-            selected_layer_areas.changeAttributeValue(area.id(), 0, current + 1)
-            selected_layer_areas.updateFeature(area)
-
-            #### collect all parts of each dissolved area into one layer and convert attribures to df
-            layer = QgsVectorLayer("Polygon", "temp", "memory")
-            layer.dataProvider().addAttributes(fields)
-            layer.updateFields() 
-            parts = []
-            for part in selected_layer_pieces.getFeatures():
-                if area.geometry().intersects(part.geometry()):
-                    parts.append(part)
-            layer.dataProvider().addFeatures(parts)
-            df = attributes_to_df(layer)
-
-            #### select areas where "Temperate tussock grasslands" is present    
-            if VARS["veg_name"] in set(df['MVS_NAME'].tolist()):
-                #### add the dissolved area id for selection
-                area_ids.append(area.id())
-
-                #### get stats on vegetation
-                veg_sum_df = df.groupby(['MVS_NAME']).agg({'Shape_Area': 'sum'})
-                veg_sum_df['veg_perc'] = veg_sum_df['Shape_Area'] / veg_sum_df['Shape_Area'].sum()
-                veg_sum_df.to_csv(f"{self.csv_path}/vegetation_stats_area_{current+1}.csv")
-
-                log(f"vegetation statistics for area {area.id()} saved to '.data/csv/' folder")
-
-            current +=1
-            feedback.setProgress(int(current * total))
-        selected_layer_areas.commitChanges()
-
-        selected_layer_areas.selectByIds(area_ids)
-        result_layer = processing.run("native:saveselectedfeatures", {'INPUT': selected_layer_areas, 'OUTPUT': 'memory:'})['OUTPUT']
-        selected_layer_areas.removeSelection()
 
+        #### set the feature ID to consequent integers, numbering follows the feature order so it stays deterministic
+        keyed = [(current + 1, area) for current, area in enumerate(selected_layer_areas.getFeatures())]
+        if coarse:
+            #### the coarse-to-fine mode builds only a part of the areas, so the OBJECTID is the Hilbert key of a point on the area
+            #### surface over the study area, with the rank of the area by its bounding box among the areas of the same cell.
+            #### It does not depend on the areas of the other cells, the numbers stay within the 32-bit integer
+            extent = LAYERS['admin'].extent()
+            cells = {}
+            for current, area in keyed:
+                geometry = area.geometry()
+                point = geometry.pointOnSurface().asPoint()
+                box = geometry.boundingBox()
+                cell = hilbert_key(point.x(), point.y(), extent, order=14)
+                cells.setdefault(cell, []).append(((box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()), area))
+            keyed = []
+            for cell, cell_areas in sorted(cells.items()):
+                if len(cell_areas) > 7:
+                    raise QgsProcessingException(f"{len(cell_areas)} areas share one Hilbert cell, the areas can not be numbered")
+                cell_areas.sort(key=lambda x: x[0])
+                for rank, (box, area) in enumerate(cell_areas):
+                    keyed.append((cell * 8 + rank + 1, area))
+        #### the areas are processed under consecutive numbers in the OBJECTID order
+        areas = []
+        area_features = {}
+        object_ids = {}
+        for current, (object_id, area) in enumerate(keyed):
+            area.setAttribute(0, object_id)
+            object_ids[current + 1] = object_id
+            area_features[current + 1] = area
+            areas.append((current + 1, area.id(), QgsGeometry(area.geometry()), area['Shape_Area']))
+
+        #### RANKED MODE
+        #### the score is the share of the preferable vegetation times the site area, so the site area bounds it.
+        #### the sites with the largest bound go first and the rest are pruned once none can beat the K-th score
+        top_k = int(VARS['top_k'])
+        if top_k:
+            areas.sort(key=lambda x: -x[3])
+        site_areas = {number: site_area for number, area_id, area_geometry, site_area in areas}
+        ranking = {target: [] for target, min_share in targets}
 
         ###############################################
         ##### RESULT OUTPUT
-        add_to_map = [result_layer]
-        result = {}
-        for i, layer in enumerate(add_to_map):
-            outlayer = OUTPUT_PARAMS[f"output_{i+1}"]["output"]
-            log(f"{outlayer}")
-            (sink, i) = self.parameterAsSink(
-                # OUTPUT[f"OUTPUT_LAYER_{i+1}"],
-                parameters,
-                outlayer,
-                context,
-                layer.fields(),
-                layer.wkbType(),
-                layer.sourceCrs()
-            )
-            if sink is None:
-                raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
-
-            features = layer.getFeatures()
-
-            for current, feature in enumerate(features):
-                # Add a feature in the sink
-                sink.addFeature(feature, QgsFeatureSink.FastInsert)
-            result[outlayer] = i
-        return result
-        
+        #### accepted sites are streamed to the sink in batches during the site selection pass
+        outlayer = OUTPUT_PARAMS["output_1"]["output"]
+        log(f"{outlayer}")
+        out_fields = QgsFields(selected_layer_areas.fields())
+        #### one feature per site and target found in it
+        out_fields.append(QgsField('TARGET', QVariant.String))
+        out_fields.append(QgsField('TARGET_PERC', QVariant.Double))
+        if top_k:
+            #### keep the rank and the score of the best sites
+            out_fields.append(QgsField('RANK', QVariant.Int))
+            out_fields.append(QgsField('SCORE', QVariant.Double))
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            outlayer,
+            context,
+            out_fields,
+            selected_layer_areas.wkbType(),
+            selected_layer_areas.sourceCrs()
+        )
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, outlayer))
+
+        def output_feature(number, target, share, rank=None, score=None):
+            feature = QgsFeature(out_fields)
+            feature.setGeometry(area_features[number].geometry())
+            attributes = area_features[number].attributes() + [target, float(share)]
+            if top_k:
+                attributes += [rank, float(score)]
+            feature.setAttributes(attributes)
+            return feature
+
+        batch = []
+        def add_to_sink(feature=None):
+            #### call without a feature to flush the last batch
+            if feature is not None:
+                batch.append(feature)
+            if batch and (feature is None or len(batch) >= 500):
+                sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+                batch.clear()
+
+        #### shard the areas across the workers
+        workers = int(VARS['workers'])
+        shard_size = max(1, len(areas) // (workers * 4))
+        shards = []
+        for i in range(0, len(areas), shard_size):
+            shard = []
+            for number, area_id, area_geometry, site_area in areas[i:i + shard_size]:
+                shard.append((number, area_id, bytes(area_geometry.asWkb())))
+            shards.append(shard)
+        #### VEGETATION RASTER BACKEND, the statistics of all areas are computed up front from the raster
+        raster_stats = None
+        if VARS['veg_raster']:
+            #### the area numbers are burnt from their own field
+            areas_layer = QgsVectorLayer(f"{QgsWkbTypes.displayString(selected_layer_areas.wkbType())}?crs={selected_layer_areas.crs().authid()}&field=AREA_NUM:integer", "areas", "memory")
+            features = []
+            for number, area in area_features.items():
+                feature = QgsFeature(areas_layer.fields())
+                feature.setGeometry(area.geometry())
+                feature.setAttributes([number])
+                features.append(feature)
+            areas_layer.dataProvider().addFeatures(features)
+            raster_stats = raster_composition(VARS['veg_raster'], areas_layer, 'AREA_NUM')
+            log(f"vegetation statistics of {len(raster_stats)} areas were computed from the raster {VARS['veg_raster']}, {n - len(raster_stats)} areas without pixels use the polygon statistics")
+
+        use_processes = VARS['worker_processes'] and raster_stats is None
+        if use_processes:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
 
-        
+        #### csv files are written by a background writer so disk I/O overlaps the computation
+        #### the sites go to the sink in the area order, the ones finished ahead of their turn wait in ready
+        writes = []
+        ready = {}
+        next_number = 1
+        current = 0
+        #### the pieces are packed to shared memory only for worker processes, they attach to them read-only. Threads read the arrays directly.
+        #### with the raster they are still needed for the areas without pixels
+        packed_pieces = PackedLayer.from_layer(selected_layer_pieces, ['MVS_NAME', 'Shape_Area'], shared=use_processes)
+        try:
+            with ThreadPoolExecutor(max_workers=1) as writer, executor:
+                shards = iter(shards)
+                pending = set()
+                while True:
+                    #### keep the workers busy, stop submitting when the remaining sites can't get into the ranking
+                    while len(pending) < workers * 2:
+                        shard = next(shards, None)
+                        if shard is not None and top_k and all(len(x) == top_k and site_areas[shard[0][0]] <= x[0][0] for x in ranking.values()):
+                            shard = None
+                        if shard is None:
+                            break
+                        if raster_stats is not None:
+                            pending.add(executor.submit(raster_area_stats, raster_stats, [x for x in shard if x[0] in raster_stats], targets))
+                            #### the areas smaller than a pixel, with no pixel centre inside, fall back to the polygon statistics
+                            missing = [x for x in shard if x[0] not in raster_stats]
+                            if missing:
+                                pending.add(executor.submit(packed_area_stats, packed_pieces.descriptor, missing, targets))
+                        else:
+                            pending.add(executor.submit(packed_area_stats, packed_pieces.descriptor, shard, targets))
+                    if not pending:
+                        break
+                    done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for number, area_id, veg_sum_df, matched in future.result():
+                            current += 1
+                            if top_k:
+                                for target, share in matched:
+                                    score = share * site_areas[number]
+                                    entry = (score, -number, number, area_id, share, veg_sum_df)
+                                    if len(ranking[target]) < top_k:
+                                        heapq.heappush(ranking[target], entry)
+                                    elif entry > ranking[target][0]:
+                                        heapq.heapreplace(ranking[target], entry)
+                                continue
+                            ready[number] = [output_feature(number, target, share) for target, share in matched]
+                            if veg_sum_df is not None:
+                                writes.append(writer.submit(veg_sum_df.to_csv, f"{csv_path}/vegetation_stats_area_{object_ids[number]}.csv"))
+                                log(f"vegetation statistics for area {area_id} saved to '.data/csv/' folder")
+                            while next_number in ready:
+                                for feature in ready.pop(next_number):
+                                    add_to_sink(feature)
+                                next_number += 1
+                        feedback.setProgress(int(current * total))
+                    if feedback.isCanceled():
+                        for future in pending:
+                            future.cancel()
+                        return {}
+
+                if top_k:
+                    log(f"{n - current} areas were pruned without exact evaluation")
+                    saved = set()
+                    for target, min_share in targets:
+                        ranking[target].sort(reverse=True)
+                        log(f"{len(ranking[target])} best sites were kept for {target}")
+                        for rank, (score, _, number, area_id, share, veg_sum_df) in enumerate(ranking[target]):
+                            if number not in saved:
+                                saved.add(number)
+                                writes.append(writer.submit(veg_sum_df.to_csv, f"{csv_path}/vegetation_stats_area_{object_ids[number]}.csv"))
+                                log(f"vegetation statistics for area {area_id} saved to '.data/csv/' folder")
+                            add_to_sink(output_feature(number, target, share, rank + 1, score))
+                    feedback.setProgress(100)
+        finally:
+            packed_pieces.unlink()
+        add_to_sink()
+        #### raise the writing errors, if any
+        for write in writes:
+            write.result()
+
+        return {outlayer: dest_id}